@@ -0,0 +1,102 @@
+"""Measures the cold import time of each Function handler and which heavy dependencies it loads, using python -X importtime in a fresh interpreter per handler
+
+Run from the slv-adf-functions directory: python -m benchmarks.bench_cold_start [budget_ms]
+Exits with status 1 if a handler takes longer than budget_ms to import.
+"""
+import json
+import subprocess
+import sys
+
+HANDLERS = ["libcal", "power_bi", "vemcount"]
+# * Dependencies that should only be loaded by the handlers whose path uses them
+HEAVY_MODULES = [
+    "aiohttp",
+    "azure.identity",
+    "azure.keyvault.secrets",
+    "azure.storage.blob",
+    "pandas",
+    "psycopg2",
+    "pyodbc",
+    "requests",
+    "sqlalchemy",
+]
+REPEATS = 5
+SLOWEST = 5
+
+# * importlib.import_module bypasses the import timer, __import__ does not
+IMPORT_SCRIPT = """
+import json, sys
+__import__(sys.argv[1])
+print(json.dumps([name for name in json.loads(sys.argv[2]) if name in sys.modules]))
+"""
+
+
+def import_handler(handler):
+    """Imports a handler in a new interpreter
+
+    Returns:
+        int: Cumulative import time of the handler module in microseconds
+        list: (cumulative microseconds, module) for every module imported
+        list: HEAVY_MODULES that were loaded
+    """
+    module = f"src.handlers.{handler}"
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            IMPORT_SCRIPT,
+            module,
+            json.dumps(HEAVY_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # * Nested imports are indented below the module that imported them
+        imports.append((int(cumulative), name[1:].rstrip()))
+
+    handler_time = next(time for time, name in imports if name.strip() == module)
+    return handler_time, imports, json.loads(result.stdout)
+
+
+if __name__ == "__main__":
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    over_budget = []
+
+    for handler in HANDLERS:
+        try:
+            runs = [import_handler(handler) for _ in range(REPEATS)]
+        except ImportError as e:
+            print(f"\n{handler}: could not be imported ({e})")
+            continue
+
+        handler_ms = min(run[0] for run in runs) / 1000
+        _, imports, heavy_modules = min(runs, key=lambda run: run[0])
+        print(f"\n{handler}: {handler_ms:.1f}ms (best of {REPEATS})")
+        print(f"  heavy dependencies loaded: {', '.join(heavy_modules) or 'none'}")
+        # * Slowest packages the handler pulls in, by their most expensive import
+        packages = {}
+        for time, name in imports:
+            package = name.strip().split(".")[0]
+            if package != "src":
+                packages[package] = max(time, packages.get(package, 0))
+        for package, time in sorted(packages.items(), key=lambda item: -item[1])[
+            :SLOWEST
+        ]:
+            print(f"  {time / 1000:>8.1f}ms  {package}")
+
+        if budget_ms is not None and handler_ms > budget_ms:
+            over_budget.append(handler)
+
+    if over_budget:
+        print(f"\nOver the {budget_ms:.0f}ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
@@ -0,0 +1,77 @@
+"""Compares the cost of tracking the LibCal watermark per window as a backfill grows
+
+Run from the slv-adf-functions directory: python -m benchmarks.bench_libcal_watermark
+"""
+import time
+from datetime import date, datetime, timedelta
+
+from src.shared_code import op_libcal
+
+ROWS_PER_WINDOW = 20000
+WINDOWS = 8
+START_DATE = date(2020, 1, 1)
+
+
+def make_window(window_number):
+    """Builds one 365-day window of fake bookings, spread evenly across the window"""
+    window_start = START_DATE + timedelta(days=365 * window_number)
+    return [
+        {
+            "bookId": f"cs_{window_number}_{i}",
+            "fromDate": (window_start + timedelta(days=1 + i % 365)).strftime(
+                "%Y-%m-%dT10:00:00+11:00"
+            ),
+        }
+        for i in range(ROWS_PER_WINDOW)
+    ]
+
+
+def legacy_watermark(windows):
+    """The previous approach, re-parsing every row collected so far after each window"""
+    window_times = []
+    collected = []
+    for window in windows:
+        started = time.perf_counter()
+        collected.extend(op_libcal.format_booking_data(booking) for booking in window)
+        max(
+            datetime.strptime(element[6], "%Y-%m-%dT%H:%M:%S%z").date()
+            for element in collected
+        )
+        window_times.append(time.perf_counter() - started)
+    return window_times
+
+
+def running_watermark(windows):
+    """Drives get_booking_data_to_upload with fake pages and times each window"""
+    pages = iter(windows)
+    window_times = []
+
+    def get_booking_pages(date_to_retrieve, days, limit=500):
+        yield next(pages)
+
+    op_libcal.get_booking_pages = get_booking_pages
+    op_libcal.get_most_recent_booking = lambda: START_DATE + timedelta(
+        days=365 * len(windows)
+    )
+
+    cursor = {}
+    rows = op_libcal.get_booking_data_to_upload("bench", START_DATE, cursor)
+    started = time.perf_counter()
+    for row_number, _ in enumerate(rows, start=1):
+        if row_number % ROWS_PER_WINDOW == 0:
+            window_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+    return window_times
+
+
+if __name__ == "__main__":
+    windows = [make_window(window_number) for window_number in range(WINDOWS)]
+
+    legacy_times = legacy_watermark(windows)
+    running_times = running_watermark(windows)
+
+    print(f"{'window':>6} {'legacy (s)':>12} {'running max (s)':>16}")
+    for window_number, (legacy, running) in enumerate(
+        zip(legacy_times, running_times), start=1
+    ):
+        print(f"{window_number:>6} {legacy:>12.3f} {running:>16.3f}")
@@ -0,0 +1,155 @@
+"""Compares the string += Power BI report builder with op_power_bi_reporting.render_power_bi_report as the number of datasets grows
+
+Run from the slv-adf-functions directory: python -m benchmarks.bench_power_bi_report
+"""
+import time
+from datetime import date
+
+from src.shared_code import op_power_bi_reporting
+
+DATASETS_PER_WORKSPACE = 50
+REFRESHES_PER_DATASET = 30
+DATASET_COUNTS = [1_000, 2_000, 4_000, 8_000]
+STATUSES = ["Completed", "Completed", "Completed", "Failed", "Disabled", "Unknown"]
+
+
+def make_refresh_history(datasets):
+    """Workspaces of DATASETS_PER_WORKSPACE datasets, a few with no refreshes"""
+    refresh_history = {}
+    for dataset_number in range(datasets):
+        workspace = f"Workspace {dataset_number // DATASETS_PER_WORKSPACE}"
+        refreshes = [
+            {"status": STATUSES[(dataset_number + refresh) % len(STATUSES)]}
+            for refresh in range(REFRESHES_PER_DATASET)
+        ]
+        if dataset_number % 97 == 0:
+            refreshes = None
+        refresh_history.setdefault(workspace, {})[
+            f"Dataset {dataset_number}"
+        ] = refreshes
+    return refresh_history
+
+
+def legacy_render(refresh_history):
+    failure_report = ""
+
+    high_level_report = """
+        <table>
+            <tr>
+                <th>Workspace</th>
+                <th>Total dashboards</th>
+                <th>Completed</th>
+                <th>Failed</th>
+                <th>Disabled</th>
+                <th>Unknown</th>
+            </tr>
+        """
+
+    workspace_refreshes = {}
+    for workspace, datasets in refresh_history.items():
+
+        failure_report += f"<h2>{workspace}</h2>"
+        failure_report += """
+            <table>
+                <tr>
+                    <th>Workspace</th>
+                    <th>Refresh status</th>
+                    <th>Attempted refreshes</th>
+                    <th>Failed refreshes</th>
+                </tr>
+            """
+
+        workspace_refreshes[workspace] = {}
+
+        for dataset_name, refresh_history in datasets.items():
+
+            if refresh_history:
+
+                number_of_refresh_attempts = len(refresh_history)
+                refresh_status = refresh_history[0]["status"]
+                failures = [
+                    refresh
+                    for refresh in refresh_history
+                    if refresh["status"] == "Failed"
+                ]
+                number_of_failures = len(failures)
+            else:
+                number_of_refresh_attempts = "0"
+                number_of_failures = "n/a"
+                refresh_status = "Unknown"
+            failure_report += f"""
+                                <tr>
+                                    <td>{dataset_name}</td>
+                                    <td>{refresh_status}</td>
+                                    <td>{number_of_refresh_attempts}</td>
+                                    <td>{number_of_failures}</td>
+                                </tr>
+                            """
+            workspace_refreshes[workspace][dataset_name] = refresh_status
+
+        failure_report += "</table>"
+
+        workspace_refresh_statuses = list(workspace_refreshes[workspace].values())
+
+        high_level_report += f"""
+            <tr>
+                <td>{workspace}</td>
+                <td>{len(datasets)}</td>
+                <td>{workspace_refresh_statuses.count('Completed')}</td>
+                <td>{workspace_refresh_statuses.count('Failed')}</td>
+                <td>{workspace_refresh_statuses.count('Disabled')}</td>
+                <td>{workspace_refresh_statuses.count('Unknown')}</td>
+            </tr>
+        """
+
+    high_level_report += "</table>"
+
+    email_style = """
+    <style>
+        table, th, td  {
+            border: 1px solid black;
+            border-collapse: collapse;
+            padding: 2px;
+            }
+    </style>
+    """
+
+    email_body = f"""
+    {email_style}
+    <h1>SLV Power BI Dataset Refresh Report: {date.today()}</h1>
+    <br></br>
+    <h2>Dashboard refresh statuses</h2>
+    {high_level_report}
+    <br></br>
+    <h2>Granular report</h2>
+    {failure_report}
+    """
+    return email_body
+
+
+def time_it(function, refresh_history, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function(refresh_history)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+if __name__ == "__main__":
+    print(
+        f"{'datasets':>10} {'legacy':>10} {'renderer':>10} {'us/dataset':>12} {'speed-up':>9}"
+    )
+    for datasets in DATASET_COUNTS:
+        refresh_history = make_refresh_history(datasets)
+        assert legacy_render(refresh_history) == (
+            op_power_bi_reporting.render_power_bi_report(refresh_history)
+        )
+
+        legacy_seconds = time_it(legacy_render, refresh_history)
+        render_seconds = time_it(
+            op_power_bi_reporting.render_power_bi_report, refresh_history
+        )
+        print(
+            f"{datasets:>10,} {legacy_seconds * 1000:>8.1f}ms {render_seconds * 1000:>8.1f}ms {render_seconds / datasets * 1e6:>12.2f} {legacy_seconds / render_seconds:>8.1f}x"
+        )
@@ -0,0 +1,63 @@
+"""Compares a datetime.strptime loop with the shared_dates parsing layer on one million rows
+
+Run from the slv-adf-functions directory: python -m benchmarks.bench_timestamp_parsing
+"""
+import time
+from datetime import datetime, timedelta
+
+from src.shared_code import shared_constants, shared_dates
+
+ROWS = 1_000_000
+ZONES = 40
+
+
+def make_libcal_column():
+    """fromDate values, mostly unique as bookings start at different times"""
+    start = datetime(2020, 1, 1, 8)
+    return [
+        (start + timedelta(minutes=15 * i)).strftime("%Y-%m-%dT%H:%M:%S+11:00")
+        for i in range(ROWS)
+    ]
+
+
+def make_vemcount_column():
+    """dt values, each 30 minute slot repeats once per zone"""
+    start = datetime(2020, 1, 1)
+    return [
+        (start + timedelta(minutes=30 * (i // ZONES))).strftime("%Y-%m-%d %H:%M:%S")
+        for i in range(ROWS)
+    ]
+
+
+def time_it(label, function, *args):
+    started = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<45} {elapsed:>8.3f}s {ROWS / elapsed:>14,.0f} rows/s")
+
+
+def strptime_loop(values, operation):
+    timestamp_format = shared_constants.TIMESTAMP_FORMATS[operation]
+    return [datetime.strptime(value, timestamp_format) for value in values]
+
+
+def strptime_max_date(values, operation):
+    timestamp_format = shared_constants.TIMESTAMP_FORMATS[operation]
+    return max(datetime.strptime(value, timestamp_format).date() for value in values)
+
+
+if __name__ == "__main__":
+    for operation, column in (
+        ("libcal", make_libcal_column()),
+        ("vemcount", make_vemcount_column()),
+    ):
+        print(f"\n{operation} ({ROWS:,} rows)")
+        time_it("strptime loop", strptime_loop, column, operation)
+        time_it(
+            "shared_dates.parse_timestamp_column",
+            shared_dates.parse_timestamp_column,
+            column,
+            operation,
+        )
+        time_it("strptime watermark", strptime_max_date, column, operation)
+        time_it("shared_dates.get_max_date", shared_dates.get_max_date, column)
@@ -0,0 +1,61 @@
+"""Compares the per-cell Vemcount row building loop, followed by the loader's row by row type conversion, with op_vemcount.format_zone_data which converts the columns before building rows
+
+Run from the slv-adf-functions directory: python -m benchmarks.bench_vemcount_transform
+"""
+import time
+
+from src.shared_code import op_vemcount, shared_azure, shared_constants
+
+ZONES = 20
+DAYS = 365
+ROWS_PER_DAY = 48
+
+
+def make_dates_info(zone):
+    """A year of 30min 'dates' for one zone, shaped like the report endpoint's response"""
+    return {
+        str(slot): {
+            "data": {
+                "dt": f"2021-01-01 {slot % 24:02d}:{30 * (slot % 2):02d}:00",
+                "count_in": slot % 50,
+                "count_out": slot % 45,
+                "inside": slot % 5,
+            }
+        }
+        for slot in range(DAYS * ROWS_PER_DAY)
+    }
+
+
+def legacy_format(zone, dates_info, operation):
+    date_values = [dt["data"] for dt in dates_info.values()]
+    return [
+        [
+            zone if field == "zone_id" else date_value.get(field, "")
+            for field in shared_constants.API_FIELDS[operation]
+        ]
+        for date_value in date_values
+    ]
+
+
+def legacy_format_for_upload(zone, dates_info, operation):
+    return shared_azure.format_rows_for_table(
+        legacy_format(zone, dates_info, operation), operation
+    )
+
+
+def time_it(label, format_function, zone_data):
+    started = time.perf_counter()
+    rows = 0
+    for zone, dates_info in zone_data.items():
+        rows += len(format_function(zone, dates_info, "vemcount"))
+    elapsed = time.perf_counter() - started
+    print(
+        f"{label:<30} {rows:>10,} rows {elapsed:>8.3f}s {rows / elapsed:>14,.0f} rows/s"
+    )
+
+
+if __name__ == "__main__":
+    zone_data = {zone: make_dates_info(zone) for zone in range(ZONES)}
+
+    time_it("per-cell loop + row conversion", legacy_format_for_upload, zone_data)
+    time_it("format_zone_data", op_vemcount.format_zone_data, zone_data)
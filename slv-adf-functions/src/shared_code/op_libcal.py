@@ -1,37 +1,87 @@
 import logging
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 
-import requests
-
-from . import op_libcal, shared_azure, shared_constants
+from . import (
+    op_libcal,
+    shared_azure,
+    shared_constants,
+    shared_dates,
+    shared_helpers,
+    shared_http,
+)
 
 libcal_url = os.environ.get("LIBCAL_URL")
 libcal_client_secret = os.environ.get("LIBCAL_CLIENT_SECRET")
 libcal_client_id = os.environ.get("LIBCAL_CLIENT_ID")
 
+# * The token is shared by every request made from a warm Function instance, the lock stops concurrent fetches minting their own tokens
+_token_lock = threading.Lock()
+_token_cache = {"access_token": None, "expires_at": 0}
+_token_stats = {"tokens_minted": 0, "requests_served": 0}
+
+# * Keyed by the date it was looked up on, so repeat invocations on the same day skip the search
+_most_recent_booking_cache = {}
 
-def get_access_token():
+
+def get_access_token(rejected_token=None):
     """Retrieves access token for the LibCal API. The client_id and client_secret values are read from environmental variables
 
+    The token is cached until shortly before its 'expires_in' value runs out, so a new one is only minted when required
+
+    Args:
+        rejected_token (str, optional): A token the API has refused. If it is still the cached token a new one is minted, if another request has already replaced it the replacement is returned. Defaults to None.
+
     Returns:
         bool: if the request fails a False flag is returned
         string:  the access token
     """
-    payload = {
-        "client_id": libcal_client_id,
-        "client_secret": libcal_client_secret,
-        "grant_type": "client_credentials",
-    }
+    with _token_lock:
+        if (
+            _token_cache["access_token"]
+            and _token_cache["access_token"] != rejected_token
+            and time.monotonic() < _token_cache["expires_at"]
+        ):
+            return _token_cache["access_token"]
+
+        payload = {
+            "client_id": libcal_client_id,
+            "client_secret": libcal_client_secret,
+            "grant_type": "client_credentials",
+        }
+
+        r = shared_http.post(f"{libcal_url}oauth/token", json=payload)
+
+        if r.status_code != 200:
+            _token_cache["access_token"] = None
+            return False
+
+        token_info = r.json()
+        expires_in = int(
+            token_info.get("expires_in", shared_constants.LIBCAL_TOKEN_DEFAULT_EXPIRY)
+        )
 
-    r = requests.post(f"{libcal_url}oauth/token", json=payload)
+        _token_cache["access_token"] = token_info["access_token"]
+        _token_cache["expires_at"] = (
+            time.monotonic() + expires_in - shared_constants.LIBCAL_TOKEN_EXPIRY_MARGIN
+        )
+        _token_stats["tokens_minted"] += 1
 
-    if r.status_code != 200:
-        return False
+        return _token_cache["access_token"]
 
-    access_token = r.json()["access_token"]
 
-    return access_token
+def get_token_stats():
+    """Reports how many LibCal access tokens have been minted against how many API requests have been served
+
+    Returns:
+        dict: counts for 'tokens_minted' and 'requests_served'
+    """
+    with _token_lock:
+        return dict(_token_stats)
 
 
 def get_libcal_information(endpoint):
@@ -52,7 +102,18 @@ def get_libcal_information(endpoint):
 
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    r = requests.get(f"{libcal_url}{endpoint}", headers=headers)
+    r = shared_http.get(f"{libcal_url}{endpoint}", headers=headers)
+
+    # * A 401 means the cached token has been revoked or expired early, refresh it once and retry
+    if r.status_code == 401:
+        access_token = get_access_token(rejected_token=access_token)
+        if not access_token:
+            return False
+        headers = {"Authorization": f"Bearer {access_token}"}
+        r = shared_http.get(f"{libcal_url}{endpoint}", headers=headers)
+
+    with _token_lock:
+        _token_stats["requests_served"] += 1
 
     if r.status_code != 200:
         logging.error(r.text)
@@ -94,23 +155,126 @@ def get_bookings(date_to_retrieve=False, days=365, page=1, limit=500):
     return bookings
 
 
+def get_booking_pages(date_to_retrieve, days, limit=500, concurrency=None):
+    """Retrieves every page of bookings for a date range, speculatively requesting the next pages in parallel
+
+    Pages are yielded in order and paging stops at the first page that is short or empty
+
+    Args:
+        date_to_retrieve (date): The date from which to retrieve bookings information
+        days (int): How many days to include in the API request, max is 365
+        limit (int, optional): How many results to include per page (max 500). Defaults to 500.
+        concurrency (int, optional): Maximum number of pages requested at once. Defaults to LIBCAL_PAGE_CONCURRENCY.
+
+    Raises:
+        RuntimeError: If a page could not be retrieved from the LibCal API
+
+    Yields:
+        list: list of dicts containing booking information for one page
+    """
+    if concurrency is None:
+        concurrency = shared_constants.LIBCAL_PAGE_CONCURRENCY
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        next_page = 1
+        pending_pages = deque()
+
+        for _ in range(concurrency):
+            pending_pages.append(
+                executor.submit(get_bookings, date_to_retrieve, days, next_page, limit)
+            )
+            next_page += 1
+
+        while pending_pages:
+            bookings_info = pending_pages.popleft().result()
+
+            if bookings_info is False:
+                for pending_page in pending_pages:
+                    pending_page.cancel()
+                raise RuntimeError(
+                    f"Unable to retrieve bookings from {date_to_retrieve} for {days} days"
+                )
+
+            if bookings_info:
+                yield bookings_info
+
+            # * A short page is the last one, any pages requested after it will be empty so are discarded
+            if len(bookings_info) < limit:
+                for pending_page in pending_pages:
+                    pending_page.cancel()
+                break
+
+            pending_pages.append(
+                executor.submit(get_bookings, date_to_retrieve, days, next_page, limit)
+            )
+            next_page += 1
+
+
+def has_bookings(from_date, to_date):
+    """Checks whether any bookings exist between two dates, requesting a single result from the LibCal API
+
+    Args:
+        from_date (date): First date to check
+        to_date (date): Last date to check (inclusive), must be less than 365 days after from_date
+
+    Raises:
+        RuntimeError: If the bookings could not be retrieved from the LibCal API
+
+    Returns:
+        bool: True if at least one booking exists in the date range
+    """
+    days = (to_date - from_date).days + 1
+    bookings = get_bookings(date_to_retrieve=from_date, days=days, limit=1)
+
+    if bookings is False:
+        raise RuntimeError(
+            f"Unable to retrieve bookings from {from_date} for {days} days"
+        )
+
+    return len(bookings) > 0
+
+
 # check date of most recent booking, this is to prevent an infinite loop if there's no booking for 'today'
 def get_most_recent_booking():
     """Queries the LibCal API for the last date that an entry has been added from 'today' backwards i.e. does not include any dates in the future
 
+    Windows of doubling size are checked backwards from today until one contains a booking, then that window is bisected. The gap is found in O(log gap) API calls and the answer is reused for the rest of the day.
+
     Returns:
         date: First date from today backwards that return a non empty list from the LibCal API
     """
-    most_recent_booking = date.today()
-    most_recent_bookings = get_bookings(
-        date_to_retrieve=most_recent_booking, limit=1, days=1
-    )
+    today = date.today()
+    if today in _most_recent_booking_cache:
+        return _most_recent_booking_cache[today]
+
+    earliest_date = datetime.strptime(shared_constants.EARLIEST_DATE, "%Y-%m-%d").date()
+
+    # * Gallop backwards, every date after window_end is known to have no bookings
+    window_end = today
+    window_days = 1
+    window_start = today
+    while not has_bookings(window_start, window_end):
+        if window_start <= earliest_date:
+            logging.warning(f"No bookings found between {earliest_date} and {today}")
+            return earliest_date
+        window_end = window_start - timedelta(days=1)
+        window_days = min(window_days * 2, 365)
+        window_start = max(window_end - timedelta(days=window_days - 1), earliest_date)
+
+    # * Bisect the window for the latest date that still has bookings on or after it
+    while window_start < window_end:
+        midpoint = window_start + timedelta(
+            days=((window_end - window_start).days + 1) // 2
+        )
+        if has_bookings(midpoint, window_end):
+            window_start = midpoint
+        else:
+            window_end = midpoint - timedelta(days=1)
 
-    while len(most_recent_bookings) == 0:
-        most_recent_booking = most_recent_booking - timedelta(days=1)
-        most_recent_bookings = get_bookings(date=most_recent_booking, limit=1, days=1)
+    _most_recent_booking_cache.clear()
+    _most_recent_booking_cache[today] = window_start
 
-    return most_recent_booking
+    return window_start
 
 
 def get_users():
@@ -136,71 +300,75 @@ def format_booking_data(booking):
     return formatted_booking_info
 
 
-def get_booking_data_to_upload(environment, last_date_retrieved):
-    """Polls the LibCal API recursively from the last date recorded in the DB (or the default value if not present) and builds a list of lists containing the data to upload to the DB
+def get_booking_data_to_upload(environment, last_date_retrieved, cursor=None):
+    """Polls the LibCal API from the last date recorded in the DB (or the default value if not present) and yields the data to upload to the DB one row at a time, as each page of bookings arrives
 
     Args:
         environment (str): Staging environment (Valid values dev, test or prod)
         last_date_retrieved (datetime): Last date recorded in DB, or default value if none recorded in DB
+        cursor (dict, optional): Updated in place with the most recent 'fromDate' yielded so far under the 'last_date_retrieved' key. Once the rows yielded have been committed it can be passed back in as the start date to resume from. Defaults to None.
 
-    Returns:
-        bool: False flag returned if the process doesn't complete
-        list: List of nested lists containing metadata extracted from the LibCal API
+    Raises:
+        RuntimeError: If a page of bookings could not be retrieved from the LibCal API
+
+    Yields:
+        list: Metadata extracted from the LibCal API for a single booking
     """
     logging.info(f"Retrieving LibCal data for {environment} environment")
+    if cursor is None:
+        cursor = {}
+    cursor["last_date_retrieved"] = last_date_retrieved
+
     # Calculate no. of days since last update. If it's less than the APIs max days (365) add to the query param
     date_to_check = get_most_recent_booking()
-    returned_values_upload_list = []
-    try:
-        days_since_last_update = date_to_check - last_date_retrieved
-        days_since_last_update = int(days_since_last_update.days)
-        while days_since_last_update > 0:
-            days_since_last_update = date_to_check - last_date_retrieved
-            days_since_last_update = int(days_since_last_update.days)
-            days = min(days_since_last_update, 365)
-
-            # Query bookings API from most recent date added recursively using page param until len of returned values is less than limit
-            # * Do not include any bookings after 'today'
-            page_counter = 1
-            bookings_info = get_bookings(
-                date_to_retrieve=last_date_retrieved, days=days, page=page_counter
-            )
-
+    from_date_index = shared_constants.API_FIELDS["libcal"].index("fromDate")
+
+    days_since_last_update = date_to_check - last_date_retrieved
+    days_since_last_update = int(days_since_last_update.days)
+    while days_since_last_update > 0:
+        days = min(days_since_last_update, 365)
+
+        # Query bookings API from most recent date added, paging until a short or empty page is returned
+        # * Do not include any bookings after 'today'
+        for bookings_info in get_booking_pages(
+            last_date_retrieved, days, limit=shared_constants.LIBCAL_PAGE_LIMIT
+        ):
             values_for_upload = [
                 format_booking_data(booking) for booking in bookings_info
             ]
-            returned_values_upload_list.extend(values_for_upload)
-
-            while len(bookings_info) > 0:
-                page_counter += 1
-                bookings_info = get_bookings(
-                    date_to_retrieve=last_date_retrieved, days=days, page=page_counter
-                )
-                values_for_upload = [
-                    format_booking_data(booking) for booking in bookings_info
-                ]
-                returned_values_upload_list.extend(values_for_upload)
-
-            # * datetime.strptime(element[5],'%Y-%m-%dT%H:%M:%S%z').date() is a complicated way of converting the string returned by the API into a date format
-            last_date_retrieved = max(
-                [
-                    datetime.strptime(element[6], "%Y-%m-%dT%H:%M:%S%z").date()
-                    for element in returned_values_upload_list
-                ]
+            # * The high-water mark is updated as each page is formatted, only the page's most recent 'fromDate' is parsed
+            page_last_date = shared_dates.get_max_date(
+                element[from_date_index] for element in values_for_upload
             )
-            logging.info(f"Data retrieved up to: {last_date_retrieved}")
+            if page_last_date and page_last_date > cursor["last_date_retrieved"]:
+                cursor["last_date_retrieved"] = page_last_date
+            yield from values_for_upload
 
-    except Exception as e:
-        logging.error(f"The following error occurred: {e}. Process aborted")
-        return False
+        # * If nothing was booked after the start of the window skip past it, otherwise the same window would be requested forever
+        if cursor["last_date_retrieved"] > last_date_retrieved:
+            last_date_retrieved = cursor["last_date_retrieved"]
+        else:
+            last_date_retrieved = last_date_retrieved + timedelta(days=days)
+        logging.info(f"Data retrieved up to: {last_date_retrieved}")
+
+        days_since_last_update = date_to_check - last_date_retrieved
+        days_since_last_update = int(days_since_last_update.days)
 
     logging.info("Completed LibCal data extraction")
-    return returned_values_upload_list
+    token_stats = get_token_stats()
+    logging.info(
+        f"{token_stats['tokens_minted']} access token(s) minted for {token_stats['requests_served']} LibCal requests"
+    )
 
 
-def upload_libcal_data_to_azure():
+def upload_libcal_data_to_azure(last_date_retrieved):
     """Coordinates the retrieval of data from Libcal and subsequent upload to Azure SQL database
 
+    Rows are uploaded in batches of LIBCAL_UPLOAD_BATCH_SIZE as they are retrieved, so memory use stays flat and batches already committed are kept if a later one fails. The most recent 'fromDate' in each batch is saved as the watermark in the same transaction as the batch, so a rerun resumes from there rather than from the start.
+
+    Args:
+        last_date_retrieved (str): Date to retrieve bookings from, in the format YYYY-MM-DD. If empty the saved watermark is used, or the most recent 'fromDate' in the table if there isn't one, or EARLIEST_DATE if the table is empty.
+
     Returns:
         bool: Returns True/False to indicate success of the operation
     """
@@ -212,72 +380,81 @@ def upload_libcal_data_to_azure():
 
     if not table_exists:
         shared_azure.create_azure_sql_table(environment, operation, prefix)
-        last_date_retrieved = datetime.strptime(
-            shared_constants.EARLIEST_DATE, "%Y-%m-%d"
-        ).date()
-    else:
-        last_date_retrieved = shared_azure.get_most_recent_date_in_db(
-            environment, operation, "fromDate", prefix="stg"
-        )
-        last_date_retrieved = datetime.strptime(
-            last_date_retrieved, "%Y-%m-%dT%H:%M:%S%z"
-        ).date()
-
-    logging.info(f"Last date retrieved: {last_date_retrieved}")
-
-    libcal_data_for_upload = op_libcal.get_booking_data_to_upload(
-        environment, last_date_retrieved
-    )
-    if libcal_data_for_upload == False:
-        logging.error("There was a problem retrieving data from LibCal")
+    elif not shared_azure.migrate_azure_sql_table(environment, operation, prefix):
+        logging.error("Unable to migrate the LibCal table to typed columns")
         return False
 
-    if len(libcal_data_for_upload) == 0:
-        logging.warning("No new data to extract from LibCal")
-        return False
+    # * Resume from the saved watermark if a previous run committed past the requested date
+    watermark = shared_azure.get_watermark(environment, operation)
+    if last_date_retrieved:
+        last_date_retrieved = shared_dates.parse_date(last_date_retrieved)
+        if watermark and watermark > last_date_retrieved:
+            logging.info(f"Resuming from watermark {watermark}")
+            last_date_retrieved = watermark
+    elif watermark:
+        last_date_retrieved = watermark
+    elif table_exists:
+        # * No watermark has been saved yet, e.g. the first run after the watermark table was added, so resume from the bookings already loaded. Rows are upserted, so the most recent day is retrieved again
+        last_date_retrieved = shared_dates.parse_date(
+            shared_azure.get_most_recent_date_in_db(
+                environment, operation, "fromDate", prefix=prefix
+            )
+            or shared_constants.EARLIEST_DATE
+        )
+    else:
+        last_date_retrieved = shared_dates.parse_date(shared_constants.EARLIEST_DATE)
 
-    logging.info(f"{len(libcal_data_for_upload)} rows extracted from LibCal")
+    logging.info(f"Last date retrieved: {last_date_retrieved}")
 
-    upload_complete = shared_azure.bulk_upload_azure_database(
-        libcal_data_for_upload, environment, "libcal", prefix
+    cursor = {}
+    libcal_rows = op_libcal.get_booking_data_to_upload(
+        environment, last_date_retrieved, cursor
     )
 
-    return upload_complete
-
-
-def upload_libcal_data_to_azure(last_date_retrieved):
-    """Coordinates the retrieval of data from Libcal and subsequent upload to Azure SQL database
-
-    Returns:
-        bool: Returns True/False to indicate success of the operation
-    """
-    environment = os.environ.get("ENVIRONMENT")
-    prefix = "stg"
-
-    table_exists = shared_azure.check_if_table_exists(environment, prefix)
-
-    if not table_exists:
-        shared_azure.create_azure_sql_table(environment, prefix)
-
-    logging.info(f"Last date retrieved: {last_date_retrieved}")
-
-    last_date_retrieved = datetime.strptime(last_date_retrieved, "%Y-%m-%d").date()
+    # * Windows restart from their start date inclusive, so rows are upserted on 'bookId' rather than inserted
+    upsert_totals = {"inserted": 0, "updated": 0, "skipped": 0}
+    rows_uploaded = 0
+    from_date_index = shared_constants.API_FIELDS[operation].index("fromDate")
+    try:
+        for libcal_data_for_upload in shared_helpers.batch_iterable(
+            libcal_rows, shared_constants.LIBCAL_UPLOAD_BATCH_SIZE
+        ):
+            # * A batch can end part way through a page, so the watermark comes from the rows in the batch rather than the cursor
+            batch_last_date = shared_dates.get_max_date(
+                row[from_date_index] for row in libcal_data_for_upload
+            )
+            upsert_counts = shared_azure.upsert_azure_database(
+                libcal_data_for_upload,
+                environment,
+                operation,
+                prefix,
+                watermark=batch_last_date,
+            )
+            if not upsert_counts:
+                logging.error(
+                    f"Upload stopped after {rows_uploaded} rows were added to the database"
+                )
+                return False
+            for count_name, count in upsert_counts.items():
+                upsert_totals[count_name] += count
+            rows_uploaded += len(libcal_data_for_upload)
+            logging.info(
+                f"{rows_uploaded} rows committed up to {batch_last_date}, bookings retrieved up to {cursor['last_date_retrieved']}"
+            )
 
-    libcal_data_for_upload = op_libcal.get_booking_data_to_upload(
-        environment, last_date_retrieved
-    )
-    if libcal_data_for_upload == False:
-        logging.error("There was a problem retrieving data from LibCal")
+    except Exception as e:
+        logging.error(
+            f"The following error occurred: {e}. Process aborted after {rows_uploaded} rows were added to the database"
+        )
         return False
 
-    if len(libcal_data_for_upload) == 0:
+    if rows_uploaded == 0:
         logging.warning("No new data to extract from LibCal")
         return False
 
-    logging.info(f"{len(libcal_data_for_upload)} rows extracted from LibCal")
-
-    upload_complete = shared_azure.bulk_upload_azure_database(
-        libcal_data_for_upload, environment, prefix
+    logging.info(
+        f"{rows_uploaded} rows extracted from LibCal: {upsert_totals['inserted']} inserted, {upsert_totals['updated']} updated and {upsert_totals['skipped']} skipped"
     )
+    shared_azure.log_sql_metrics()
 
-    return upload_complete
+    return True
@@ -1,22 +1,51 @@
 import logging
 from datetime import date
+from html import escape
 
 from . import shared_power_bi
 
+REPORTED_STATUSES = ["Completed", "Failed", "Disabled", "Unknown"]
 
-def create_power_bi_report_email():
 
-    refresh_history = shared_power_bi.get_refresh_history()
+def summarise_dataset(dataset_refresh_history):
+    """Summarises one dataset's refresh history in a single pass
 
-    if not refresh_history:
-        logging.error("Unable to retrieve Power BI data")
-        return False
+    Args:
+        dataset_refresh_history (list): Refreshes, most recent first
 
-    logging.info("Power BI refresh history retrieved. Creating email body")
+    Returns:
+        str: Status of the most recent refresh, 'Unknown' if there are none
+        str: Number of refreshes attempted
+        str: Number of failed refreshes, 'n/a' if there are none
+    """
+    if not dataset_refresh_history:
+        return "Unknown", "0", "n/a"
+
+    number_of_failures = 0
+    for refresh in dataset_refresh_history:
+        if refresh["status"] == "Failed":
+            number_of_failures += 1
 
-    failure_report = ""
+    return (
+        dataset_refresh_history[0]["status"],
+        str(len(dataset_refresh_history)),
+        str(number_of_failures),
+    )
 
-    high_level_report = """
+
+def render_power_bi_report(refresh_history):
+    """Renders the refresh history as the HTML body of the report email
+
+    Every workspace and dataset is visited once, the status counts for the summary table are totalled while the granular rows are written, and the HTML is joined from a list of parts at the end.
+
+    Args:
+        refresh_history (dict): Refresh history keyed by workspace name and then dataset name, see shared_power_bi.get_refresh_history()
+
+    Returns:
+        str: HTML email body
+    """
+    high_level_report = [
+        """
         <table>
             <tr>
                 <th>Workspace</th>
@@ -27,12 +56,15 @@ def create_power_bi_report_email():
                 <th>Unknown</th>
             </tr>
         """
+    ]
+    failure_report = []
 
-    workspace_refreshes = {}
     for workspace, datasets in refresh_history.items():
+        workspace = escape(workspace)
+        status_counts = dict.fromkeys(REPORTED_STATUSES, 0)
 
-        failure_report += f"<h2>{workspace}</h2>"
-        failure_report += """
+        failure_report.append(
+            f"""<h2>{workspace}</h2>
             <table>
                 <tr>
                     <th>Workspace</th>
@@ -41,51 +73,44 @@ def create_power_bi_report_email():
                     <th>Failed refreshes</th>
                 </tr>
             """
-
-        workspace_refreshes[workspace] = {}
-
-        for dataset_name, refresh_history in datasets.items():
-
-            if refresh_history:
-
-                number_of_refresh_attempts = len(refresh_history)
-                refresh_status = refresh_history[0]["status"]
-                failures = [
-                    refresh
-                    for refresh in refresh_history
-                    if refresh["status"] == "Failed"
-                ]
-                number_of_failures = len(failures)
-            else:
-                number_of_refresh_attempts = "0"
-                number_of_failures = "n/a"
-                refresh_status = "Unknown"
-            failure_report += f"""
+        )
+
+        for dataset_name, dataset_refresh_history in datasets.items():
+            (
+                refresh_status,
+                number_of_refresh_attempts,
+                number_of_failures,
+            ) = summarise_dataset(dataset_refresh_history)
+            if refresh_status in status_counts:
+                status_counts[refresh_status] += 1
+
+            failure_report.append(
+                f"""
                                 <tr>
-                                    <td>{dataset_name}</td>
-                                    <td>{refresh_status}</td>
+                                    <td>{escape(dataset_name)}</td>
+                                    <td>{escape(refresh_status)}</td>
                                     <td>{number_of_refresh_attempts}</td>
                                     <td>{number_of_failures}</td>
                                 </tr>
                             """
-            workspace_refreshes[workspace][dataset_name] = refresh_status
+            )
 
-        failure_report += "</table>"
+        failure_report.append("</table>")
 
-        workspace_refresh_statuses = list(workspace_refreshes[workspace].values())
-
-        high_level_report += f"""
+        high_level_report.append(
+            f"""
             <tr>
                 <td>{workspace}</td>
                 <td>{len(datasets)}</td>
-                <td>{workspace_refresh_statuses.count('Completed')}</td>
-                <td>{workspace_refresh_statuses.count('Failed')}</td>
-                <td>{workspace_refresh_statuses.count('Disabled')}</td>
-                <td>{workspace_refresh_statuses.count('Unknown')}</td>
+                <td>{status_counts['Completed']}</td>
+                <td>{status_counts['Failed']}</td>
+                <td>{status_counts['Disabled']}</td>
+                <td>{status_counts['Unknown']}</td>
             </tr>
         """
+        )
 
-    high_level_report += "</table>"
+    high_level_report.append("</table>")
 
     email_style = """
     <style>
@@ -97,14 +122,33 @@ def create_power_bi_report_email():
     </style>
     """
 
-    email_body = f"""
+    return "".join(
+        [
+            f"""
     {email_style}
     <h1>SLV Power BI Dataset Refresh Report: {date.today()}</h1>
     <br></br>
     <h2>Dashboard refresh statuses</h2>
-    {high_level_report}
+    """,
+            *high_level_report,
+            """
     <br></br>
     <h2>Granular report</h2>
-    {failure_report}
-    """
-    return email_body
+    """,
+            *failure_report,
+            "\n    ",
+        ]
+    )
+
+
+def create_power_bi_report_email():
+
+    refresh_history = shared_power_bi.get_refresh_history()
+
+    if not refresh_history:
+        logging.error("Unable to retrieve Power BI data")
+        return False
+
+    logging.info("Power BI refresh history retrieved. Creating email body")
+
+    return render_power_bi_report(refresh_history)
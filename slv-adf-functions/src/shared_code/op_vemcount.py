@@ -1,11 +1,13 @@
 import calendar
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from itertools import repeat
+from operator import itemgetter
 
-import requests
-
-from . import shared_azure, shared_constants
+from . import shared_azure, shared_constants, shared_dates, shared_helpers, shared_http
 
 
 def get_access_token():
@@ -23,7 +25,7 @@ def get_access_token():
         "Api-Key": api_key,
     }
 
-    r = requests.post(f"{base_url}auth/login", headers=headers)
+    r = shared_http.post(f"{base_url}auth/login", headers=headers)
 
     if r.status_code != 200:
         return False
@@ -39,7 +41,7 @@ def get_vemcount_information(endpoint, access_token, http_method):
 
     headers = {"Accept": "application/json", "Authorization": f"Bearer {access_token}"}
 
-    r = requests.request(http_method, f"{base_url}{endpoint}", headers=headers)
+    r = shared_http.request(http_method, f"{base_url}{endpoint}", headers=headers)
 
     if r.status_code != 200:
 
@@ -71,88 +73,276 @@ def get_last_date_in_month(from_date):
     return date(year, month, eo_month[1])
 
 
-def call_all_zones(zone_list, access_token, date_from, date_to):
+def get_zone_dates(zone, access_token, date_from, date_to):
+    """Retrieves the 'report' data for a single zone between two dates
+
+    Args:
+        zone (int): Vemcount zone id
+        access_token (str): Vemcount access token
+        date_from (str): First date to retrieve, in the format YYYY-MM-DD
+        date_to (str): Last date to retrieve, in the format YYYY-MM-DD
+
+    Raises:
+        RuntimeError: If the report could not be retrieved from the Vemcount API
+
+    Returns:
+        dict: The 'dates' returned for the zone
+    """
+    endpoint = f"report?source=zones&data={str(zone)}&data_output=inside&period_step=30min&form_date_from={date_from}&form_date_to={date_to}"
+    zone_info = get_vemcount_information(endpoint, access_token, "post")
+
+    if not zone_info:
+        raise RuntimeError(
+            f"Unable to retrieve data for zone {zone} between {date_from} and {date_to}"
+        )
+
+    dates_info = zone_info["yesterday"][str(zone)]["dates"]
+    logging.info(f"{len(dates_info)} rows retrieved for zone: {zone}")
+
+    return dates_info
+
 
-    data = {}
+def call_all_zones(zone_list, access_token, date_from, date_to, concurrency=None):
+    """Retrieves the 'report' data for every zone between two dates, requesting up to 'concurrency' zones at once
 
-    for zone in zone_list:
-        endpoint = f"report?source=zones&data={str(zone)}&data_output=inside&period_step=30min&form_date_from={date_from}&form_date_to={date_to}"
-        zone_info = get_vemcount_information(endpoint, access_token, "post")
-        dates_info = zone_info["yesterday"][str(zone)]["dates"]
-        data[zone] = dates_info
-        logging.info(f"{len(dates_info)} rows retrieved for zone: {zone}")
+    Args:
+        zone_list (list): Vemcount zone ids
+        access_token (str): Vemcount access token, shared by every request
+        date_from (str): First date to retrieve, in the format YYYY-MM-DD
+        date_to (str): Last date to retrieve, in the format YYYY-MM-DD
+        concurrency (int, optional): Maximum number of zones requested at once. Defaults to VEMCOUNT_ZONE_CONCURRENCY.
+
+    Returns:
+        dict: The 'dates' returned for each zone, keyed by zone id in the same order as zone_list
+    """
+    if concurrency is None:
+        concurrency = shared_constants.VEMCOUNT_ZONE_CONCURRENCY
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        zone_requests = {
+            zone: executor.submit(
+                get_zone_dates, zone, access_token, date_from, date_to
+            )
+            for zone in zone_list
+        }
+        data = {
+            zone: zone_request.result() for zone, zone_request in zone_requests.items()
+        }
 
     return data
 
 
-def get_zone_info_for_upload(
-    zone_list, operation, environment, prefix, last_date_retrieved, access_token
-):
+def plan_next_window(window_days, rows_per_zone, elapsed_seconds):
+    """Chooses how many days the next report window should span, based on the size and duration of the last one
+
+    The window grows through quiet periods and shrinks when a zone's response nears VEMCOUNT_MAX_ROWS_PER_REQUEST or the requests take longer than VEMCOUNT_TARGET_REQUEST_SECONDS. It never grows by more than double per step.
+
+    Args:
+        window_days (int): Number of days the last window spanned
+        rows_per_zone (int): Largest number of rows returned for a single zone in the last window
+        elapsed_seconds (float): Time taken to retrieve the last window
+
+    Returns:
+        int: Number of days the next window should span
+    """
+    next_window_days = window_days * 2
+
+    if rows_per_zone:
+        rows_per_day = rows_per_zone / window_days
+        next_window_days = min(
+            next_window_days,
+            shared_constants.VEMCOUNT_MAX_ROWS_PER_REQUEST / rows_per_day,
+        )
+
+    if elapsed_seconds > shared_constants.VEMCOUNT_TARGET_REQUEST_SECONDS:
+        next_window_days = min(
+            next_window_days,
+            window_days
+            * shared_constants.VEMCOUNT_TARGET_REQUEST_SECONDS
+            / elapsed_seconds,
+        )
+
+    next_window_days = min(
+        int(next_window_days), shared_constants.VEMCOUNT_MAX_WINDOW_DAYS
+    )
+
+    return max(next_window_days, 1)
+
+
+def format_zone_data(zone, dates_info, operation):
+    """Converts the 'dates' returned for a zone into rows for upload
+
+    Each API_FIELDS column is extracted in a single pass with operator.itemgetter and converted to its table type by shared_azure.format_columns_for_table() before the columns are zipped into rows, rather than looking up every cell individually
+
+    Args:
+        zone (int): Vemcount zone id
+        dates_info (dict): The 'dates' returned by the report endpoint for the zone
+        operation (str): Operation the data belongs to, used to look up the API_FIELDS
+
+    Returns:
+        list: One tuple per date, with values in API_FIELDS order ready for upload
+    """
+    date_values = list(map(itemgetter("data"), dates_info.values()))
+
+    columns = []
+    for field in shared_constants.API_FIELDS[operation]:
+        if field == "zone_id":
+            columns.append(repeat(zone, len(date_values)))
+            continue
+        try:
+            columns.append(list(map(itemgetter(field), date_values)))
+        except KeyError:
+            # * Slower path for a field that is missing from some of the dates
+            columns.append([date_value.get(field, "") for date_value in date_values])
+
+    return list(zip(*shared_azure.format_columns_for_table(columns, operation)))
+
+
+def get_zone_windows(zone_list, operation, last_date_retrieved, access_token):
+    """Retrieves the data for every zone from last_date_retrieved up to yesterday, one adaptively sized window at a time
 
-    form_date_to = last_date_retrieved + timedelta(days=7)
+    Args:
+        zone_list (list): Vemcount zone ids
+        operation (str): Operation the data belongs to, used to look up the API_FIELDS
+        last_date_retrieved (date): First date to retrieve
+        access_token (str): Vemcount access token
+
+    Yields:
+        tuple: The window's first date, last date and a list of rows ready for upload
+    """
     form_date_from = last_date_retrieved
+    window_days = shared_constants.VEMCOUNT_INITIAL_WINDOW_DAYS
+    report_calls = 0
 
     yesterday = date.today() - timedelta(1)
-    eo_month_yesterday = yesterday + timedelta(days=7)
 
-    while form_date_to <= eo_month_yesterday:
+    while form_date_from <= yesterday:
         data = []
-        logging.info(
-            f"Retrieving data for {len(zone_list)} zone(s) between {form_date_from} and {form_date_to}"
-        )
-
-        form_date_to = form_date_to + timedelta(days=7)
+        form_date_to = min(form_date_from + timedelta(days=window_days - 1), yesterday)
 
-        query_str_date_to = min(form_date_to, yesterday).strftime("%Y-%m-%d")
+        query_str_date_to = form_date_to.strftime("%Y-%m-%d")
         query_str_date_from = form_date_from.strftime("%Y-%m-%d")
 
+        logging.info(
+            f"Retrieving data for {len(zone_list)} zone(s) between {query_str_date_from} and {query_str_date_to} ({window_days} day window)"
+        )
+
+        started = time.monotonic()
         zone_data = call_all_zones(
             zone_list, access_token, query_str_date_from, query_str_date_to
         )
+        elapsed_seconds = time.monotonic() - started
+        report_calls += len(zone_list)
 
         for zone, dates_info in zone_data.items():
 
-            date_values = [dt["data"] for dt in dates_info.values()]
-            vemcount_values = [
-                [
-                    zone if field == "zone_id" else date_value.get(field, "")
-                    for field in shared_constants.API_FIELDS[operation]
-                ]
-                for date_value in date_values
-            ]
+            vemcount_values = format_zone_data(zone, dates_info, operation)
             data.extend(vemcount_values)
             logging.info(
                 f"{len(vemcount_values)} lines for zone {zone} from {query_str_date_from} to {query_str_date_to} ready for upload"
             )
 
+        yield form_date_from, form_date_to, data
+
+        rows_per_zone = max(
+            (len(dates_info) for dates_info in zone_data.values()), default=0
+        )
+        window_days = plan_next_window(
+            (form_date_to - form_date_from).days + 1, rows_per_zone, elapsed_seconds
+        )
         form_date_from = form_date_to + timedelta(days=1)
-        form_date_to = form_date_from + timedelta(days=7)
 
-        shared_azure.bulk_upload_azure_database(data, environment, operation, prefix)
-        logging.info(f"{len(data)} lines added")
-    return last_date_retrieved
+    logging.info(f"{report_calls} report requests made to Vemcount")
+
+
+def get_zone_info_for_upload(
+    zone_list, operation, environment, prefix, last_date_retrieved, access_token
+):
+    """Retrieves the data for every zone and uploads it to Azure SQL database one window at a time
+
+    Windows are fetched on a background thread while the previous window is uploaded, up to VEMCOUNT_PIPELINE_DEPTH windows ahead of the database. Large windows are split by date and loaded over SQL_UPLOAD_PARALLELISM connections. Each partition commits separately and the watermark is saved in its own transaction once they have all committed, so unlike smaller windows it is not saved with the data. If a run stops between the two the window is loaded again and each partition replaces the rows already committed in its date range.
+
+    Args:
+        zone_list (list): Vemcount zone ids
+        operation (str): Operation the data belongs to (Valid value vemcount)
+        environment (str): Staging environment (Valid values dev, test or prod)
+        prefix (str): Prefix for the database table name
+        last_date_retrieved (date): First date to retrieve
+        access_token (str): Vemcount access token
+
+    Raises:
+        RuntimeError: If a window could not be uploaded, fetching stops at that window
+
+    Returns:
+        date: The last date committed to the database
+    """
+    rows_uploaded = [0]
+    committed_up_to = [last_date_retrieved - timedelta(days=1)]
+
+    def upload_window(window):
+        form_date_from, form_date_to, data = window
+        upload_counts = shared_azure.partitioned_upload_azure_database(
+            data, environment, operation, prefix, watermark=form_date_to, formatted=True
+        )
+        if not upload_counts:
+            raise RuntimeError(f"Unable to upload {form_date_from} to {form_date_to}")
+        rows_uploaded[0] += len(data)
+        committed_up_to[0] = form_date_to
+        logging.info(
+            f"{upload_counts['inserted']} lines added for {form_date_from} to {form_date_to}, {upload_counts['rejected']} rejected"
+        )
+
+    pipeline_stats = shared_helpers.run_pipeline(
+        get_zone_windows(zone_list, operation, last_date_retrieved, access_token),
+        upload_window,
+        shared_constants.VEMCOUNT_PIPELINE_DEPTH,
+    )
+
+    # * Fetch and upload time overlap, so each stage's throughput is measured against the time it spent working
+    rows = rows_uploaded[0]
+    logging.info(
+        f"{rows} rows in {pipeline_stats['items']} window(s): fetched at {rows / max(pipeline_stats['producer_seconds'], 1e-6):.0f} rows/s, uploaded at {rows / max(pipeline_stats['consumer_seconds'], 1e-6):.0f} rows/s, fetching waited {pipeline_stats['producer_wait_seconds']:.1f}s on the database"
+    )
+
+    return committed_up_to[0]
 
 
 def upload_vemcount_to_azure():
+    """Coordinates the retrieval of data from Vemcount and subsequent upload to Azure SQL database
 
+    Resumes from the day after the saved watermark, or the day after the most recent date in the data table if no watermark has been recorded
+
+    Returns:
+        bool: Returns True/False to indicate success of the operation
+    """
     environment = os.environ.get("ENVIRONMENT")
     prefix = "stg"
     operation = "vemcount"
 
     table_exists = shared_azure.check_if_table_exists(environment, operation, prefix)
+    watermark = shared_azure.get_watermark(environment, operation)
 
     if not table_exists:
         shared_azure.create_azure_sql_table(environment, operation, prefix)
         last_date_retrieved = datetime.strptime(
             shared_constants.EARLIEST_DATE, "%Y-%m-%d"
         ).date()
+    elif not shared_azure.migrate_azure_sql_table(environment, operation, prefix):
+        logging.error("Unable to migrate the Vemcount table to typed columns")
+        return False
+    elif watermark:
+        last_date_retrieved = watermark + timedelta(days=1)
     else:
-        last_date_retrieved = shared_azure.get_most_recent_date_in_db(
-            environment, operation, "dt", prefix=prefix
+        last_date_retrieved = shared_dates.parse_date(
+            shared_azure.get_most_recent_date_in_db(
+                environment, operation, "dt", prefix=prefix
+            )
         )
-        last_date_retrieved = datetime.strptime(
-            last_date_retrieved, "%Y-%m-%d %H:%M:%S"
-        ).date()
+        # * The most recent day is already loaded and its rows would collide with the primary key, unless the table is empty and the default date was returned
+        if last_date_retrieved > shared_dates.parse_date(
+            shared_constants.EARLIEST_DATE
+        ):
+            last_date_retrieved = last_date_retrieved + timedelta(days=1)
 
     logging.info(f"Last date retrieved: {last_date_retrieved}")
 
@@ -162,8 +352,14 @@ def upload_vemcount_to_azure():
     if not zones:
         return False
 
-    last_date_retrieved = get_zone_info_for_upload(
-        zones, operation, environment, prefix, last_date_retrieved, access_token
-    )
+    try:
+        last_date_retrieved = get_zone_info_for_upload(
+            zones, operation, environment, prefix, last_date_retrieved, access_token
+        )
+    except Exception as e:
+        logging.error(f"The following error occurred: {e}. Process aborted")
+        return False
 
+    logging.info(f"Vemcount data committed up to: {last_date_retrieved}")
+    shared_azure.log_sql_metrics()
     return True
@@ -1,17 +1,86 @@
+import csv
+import json
 import logging
 import os
-from datetime import datetime
+import queue
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-import pyodbc
-import sqlalchemy
-from azure.identity import ClientSecretCredential
-from azure.keyvault.secrets import SecretClient
+from . import shared_constants, shared_dates, shared_helpers
 
-from . import shared_constants
+# * pyodbc, sqlalchemy and the Azure SDK clients are imported by the functions that use them, so Functions that never touch them don't load them on a cold start
+
+# * Credentials, secrets and access tokens are kept between warm invocations so AAD and Key Vault are only called when they expire
+_credentials = {}
+_secret_clients = {}
+_secret_cache = {}
+_token_cache = {}
+_credentials_lock = threading.Lock()
+
+
+def get_credential(credential_name):
+    """Returns the service principal credential for one of the AZURE_CREDENTIALS entries, created on first use
+
+    Args:
+        credential_name (str): Key in AZURE_CREDENTIALS (Valid values azure or power_bi)
+
+    Returns:
+        ClientSecretCredential: The credential, shared by every caller in the Function instance
+    """
+    from azure.identity import ClientSecretCredential
+
+    with _credentials_lock:
+        if credential_name not in _credentials:
+            tenant_id, client_id, client_secret = (
+                os.environ.get(variable)
+                for variable in shared_constants.AZURE_CREDENTIALS[credential_name]
+            )
+            _credentials[credential_name] = ClientSecretCredential(
+                tenant_id=tenant_id,
+                client_id=client_id,
+                client_secret=client_secret,
+            )
+        return _credentials[credential_name]
+
+
+def get_access_token(credential_name, scope):
+    """Returns an AAD access token for a scope, reusing the cached token until it is within AZURE_TOKEN_REFRESH_MARGIN seconds of expiring
+
+    Args:
+        credential_name (str): Key in AZURE_CREDENTIALS (Valid values azure or power_bi)
+        scope (str): Scope the token is for e.g. POWER_BI_SCOPE
+
+    Returns:
+        str: The access token
+    """
+    cache_key = (credential_name, scope)
+
+    with _credentials_lock:
+        cached_token = _token_cache.get(cache_key)
+    if (
+        cached_token
+        and time.time()
+        < cached_token.expires_on - shared_constants.AZURE_TOKEN_REFRESH_MARGIN
+    ):
+        return cached_token.token
+
+    logging.info(f"Requesting {credential_name} access token for {scope}")
+    access_token = get_credential(credential_name).get_token(scope)
+
+    with _credentials_lock:
+        _token_cache[cache_key] = access_token
+
+    return access_token.token
 
 
 def get_key_vault_secret(secret_to_retrieve, vault_url):
-    """Retrieves a secret from Azure Key Vault
+    """Retrieves a secret from Azure Key Vault, cached for KEY_VAULT_SECRET_TTL_SECONDS
 
     Args:
         secret_to_retrieve (str): Name of the key to retrieve (must match exactly the name in hte Azure key vault)
@@ -21,25 +90,204 @@ def get_key_vault_secret(secret_to_retrieve, vault_url):
         bool: False flag returned to indicate that the function failed
         str: The key vault secret value
     """
-    azure_client_id = os.environ.get("AZURE_CLIENT_ID")
-    azure_client_secret = os.environ.get("AZURE_CLIENT_SECRET")
-    azure_tenant_id = os.environ.get("AZURE_TENANT_ID")
+    from azure.keyvault.secrets import SecretClient
 
-    credentials = ClientSecretCredential(
-        client_id=azure_client_id,
-        client_secret=azure_client_secret,
-        tenant_id=azure_tenant_id,
-    )
-    client = SecretClient(credential=credentials, vault_url=vault_url)
+    cache_key = (vault_url, secret_to_retrieve)
+
+    with _credentials_lock:
+        cached_secret = _secret_cache.get(cache_key)
+    if cached_secret and time.monotonic() < cached_secret[1]:
+        return cached_secret[0]
+
+    credential = get_credential("azure")
+    with _credentials_lock:
+        if vault_url not in _secret_clients:
+            _secret_clients[vault_url] = SecretClient(
+                credential=credential, vault_url=vault_url
+            )
+        client = _secret_clients[vault_url]
     key_vault_secret = client.get_secret(secret_to_retrieve)
 
     if not key_vault_secret.value:
         logging.warning("Unable to retrieve key vault secret")
         return False
 
+    with _credentials_lock:
+        _secret_cache[cache_key] = (
+            key_vault_secret.value,
+            time.monotonic() + shared_constants.KEY_VAULT_SECRET_TTL_SECONDS,
+        )
+
     return key_vault_secret.value
 
 
+# * Connections are kept open between warm invocations, keyed by environment
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+_sqlalchemy_engines = {}
+# * (environment, table name) pairs known to exist, or to have typed columns, so they are only checked once per Function instance
+_existing_tables = set()
+_typed_tables = set()
+_sql_metrics = {
+    "connections_opened": 0,
+    "connect_seconds": 0.0,
+    "queries": 0,
+    "query_seconds": 0.0,
+}
+_sql_metrics_lock = threading.Lock()
+
+
+def get_connection_string(environment):
+    """Builds the ODBC connection string for an environment's Azure SQL database
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+
+    Returns:
+        str: ODBC connection string
+    """
+    username = os.environ.get("SQL_ADMIN_USER")
+    password = os.environ.get("SQL_ADMIN_PASSWORD")
+
+    return f"Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:slv-{environment}-sqldw.database.windows.net,1433;Database={environment}-edw;Uid={username};Pwd={{{password}}};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
+
+
+def record_sql_metric(metric, seconds):
+    """Adds a timing to the SQL metrics
+
+    Args:
+        metric (str): Either 'connect' or 'query'
+        seconds (float): Time taken
+    """
+    with _sql_metrics_lock:
+        if metric == "connect":
+            _sql_metrics["connections_opened"] += 1
+            _sql_metrics["connect_seconds"] += seconds
+        else:
+            _sql_metrics["queries"] += 1
+            _sql_metrics["query_seconds"] += seconds
+
+
+def get_sql_metrics():
+    """Reports the number of connections opened and queries run, and the time spent on each, since the Function instance started
+
+    Returns:
+        dict: 'connections_opened', 'connect_seconds', 'queries' and 'query_seconds'
+    """
+    with _sql_metrics_lock:
+        return dict(_sql_metrics)
+
+
+def log_sql_metrics():
+    """Logs the SQL connect time against query time"""
+    sql_metrics = get_sql_metrics()
+    logging.info(
+        f"SQL: {sql_metrics['connections_opened']} connection(s) opened in {sql_metrics['connect_seconds']:.2f}s, {sql_metrics['queries']} queries run in {sql_metrics['query_seconds']:.2f}s"
+    )
+
+
+def _get_connection_pool(environment):
+    with _connection_pools_lock:
+        if environment not in _connection_pools:
+            _connection_pools[environment] = {
+                "idle": queue.LifoQueue(maxsize=shared_constants.SQL_POOL_MAXSIZE),
+                "slots": threading.BoundedSemaphore(shared_constants.SQL_POOL_MAXSIZE),
+            }
+        return _connection_pools[environment]
+
+
+def _convert_datetimeoffset(value):
+    # * pyodbc can't read datetimeoffset columns natively, the value arrives as a packed struct
+    parts = struct.unpack("<6hI2h", value)
+    return datetime(
+        parts[0],
+        parts[1],
+        parts[2],
+        parts[3],
+        parts[4],
+        parts[5],
+        parts[6] // 1000,
+        timezone(timedelta(hours=parts[7], minutes=parts[8])),
+    )
+
+
+def _open_connection(environment):
+    import pyodbc
+
+    started = time.perf_counter()
+    con = pyodbc.connect(get_connection_string(environment))
+    con.add_output_converter(
+        shared_constants.SQL_DATETIMEOFFSET_TYPE, _convert_datetimeoffset
+    )
+    record_sql_metric("connect", time.perf_counter() - started)
+    return con
+
+
+def _is_connection_healthy(con):
+    try:
+        con.cursor().execute("SELECT 1").fetchall()
+        return True
+    except Exception:
+        return False
+
+
+@contextmanager
+def get_connection(environment):
+    """Borrows a connection from the environment's pool, opening a new one if none are idle
+
+    Connections that have been idle for longer than SQL_POOL_HEALTH_CHECK_SECONDS are checked before being reused. If the block raises an exception the connection is rolled back and discarded rather than returned to the pool.
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+
+    Raises:
+        TimeoutError: If SQL_POOL_MAXSIZE connections are already in use for SQL_POOL_TIMEOUT_SECONDS
+
+    Yields:
+        pyodbc.Connection: An open connection, callers are responsible for committing
+    """
+    pool = _get_connection_pool(environment)
+
+    if not pool["slots"].acquire(timeout=shared_constants.SQL_POOL_TIMEOUT_SECONDS):
+        raise TimeoutError(f"No {environment} database connections available")
+
+    try:
+        con = None
+        while con is None and not pool["idle"].empty():
+            try:
+                con, last_used = pool["idle"].get_nowait()
+            except queue.Empty:
+                break
+            idle_seconds = time.monotonic() - last_used
+            if (
+                idle_seconds > shared_constants.SQL_POOL_HEALTH_CHECK_SECONDS
+                and not _is_connection_healthy(con)
+            ):
+                logging.info("Discarding stale database connection")
+                con.close()
+                con = None
+
+        if con is None:
+            con = _open_connection(environment)
+
+        try:
+            yield con
+        except Exception:
+            try:
+                con.rollback()
+                con.close()
+            except Exception:
+                pass
+            raise
+
+        try:
+            pool["idle"].put_nowait((con, time.monotonic()))
+        except queue.Full:
+            con.close()
+    finally:
+        pool["slots"].release()
+
+
 def check_if_table_exists(environment, operation, prefix=False):
     """Checks if a database table exists
 
@@ -54,6 +302,9 @@ def check_if_table_exists(environment, operation, prefix=False):
     if prefix:
         table_name = f"{prefix}_{table_name}"
 
+    if (environment, table_name) in _existing_tables:
+        return True
+
     logging.info(
         f"Checking if table: {table_name} already exists in {environment} database"
     )
@@ -70,35 +321,38 @@ def check_if_table_exists(environment, operation, prefix=False):
         return False
 
     logging.info(f"{table_name} does exist")
+    _existing_tables.add((environment, table_name))
     return True
 
 
-def query_azure_database(sql_statement, environment, return_data=False):
+def query_azure_database(
+    sql_statement, environment, return_data=False, parameters=None
+):
     """Queries Azure SQL database
 
     Args:
         sql_statement (str): SQL query to run against the database
         environment (str): Staging environment (Valid values dev, test or prod).
         return_data (bool, optional): Flag to indicate whether to return the result of the successful SQL query. Defaults to False.
+        parameters (list, optional): Values for any '?' placeholders in the SQL query. Defaults to None.
 
     Returns:
         bool: Flag to indicate success of the function
         list: Data returned by the SQL query
     """
-    username = os.environ.get("SQL_ADMIN_USER")
-    password = os.environ.get("SQL_ADMIN_PASSWORD")
-
-    connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:slv-{environment}-sqldw.database.windows.net,1433;Database={environment}-edw;Uid={username};Pwd={{{password}}};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
-
     try:
         data_to_return = True
-        con = pyodbc.connect(connection_string)
-        cursor = con.cursor()
-        cursor.execute(sql_statement)
-        if return_data:
-            data_to_return = cursor.fetchall()
-        con.commit()
-        con.close()
+        with get_connection(environment) as con:
+            started = time.perf_counter()
+            cursor = con.cursor()
+            if parameters:
+                cursor.execute(sql_statement, parameters)
+            else:
+                cursor.execute(sql_statement)
+            if return_data:
+                data_to_return = cursor.fetchall()
+            con.commit()
+            record_sql_metric("query", time.perf_counter() - started)
 
         return data_to_return
     except Exception as e:
@@ -109,6 +363,35 @@ def query_azure_database(sql_statement, environment, return_data=False):
         return False
 
 
+def get_create_table_sql(operation, table_name):
+    """Builds the SQL to create a table using the operation's TABLE_SCHEMAS, with a primary key and a clustered index on the column loads resume from
+
+    Args:
+        operation (str): Operation the table is for (Valid values libcal or vemcount)
+        table_name (str): Name of the table to create
+
+    Returns:
+        str: CREATE TABLE and CREATE INDEX statements
+    """
+    table_schema = shared_constants.TABLE_SCHEMAS[operation]
+    db_columns = [
+        f"[{field}] {table_schema['columns'][field]}"
+        for field in shared_constants.API_FIELDS[operation]
+    ]
+    columns_string = ",".join(db_columns)
+    primary_key = ", ".join(f"[{key}]" for key in table_schema["primary_key"])
+    clustered_index = table_schema["clustered_index"]
+
+    return f"""
+        CREATE TABLE [dbo].[{table_name}] (
+            {columns_string},
+            CONSTRAINT [PK_{table_name}] PRIMARY KEY NONCLUSTERED ({primary_key})
+        );
+        CREATE CLUSTERED INDEX [IX_{table_name}_{clustered_index}]
+            ON [dbo].[{table_name}] ([{clustered_index}]);
+    """
+
+
 def create_azure_sql_table(environment, operation, prefix=False):
 
     table_name = shared_constants.DB_TABLE_NAMES[operation]
@@ -116,18 +399,177 @@ def create_azure_sql_table(environment, operation, prefix=False):
         table_name = f"{prefix}_{table_name}"
     logging.info(f'Created table "{table_name}" in {environment} database')
 
-    db_columns = [
-        f"[{field}] [nvarchar](200) NULL"
-        for field in shared_constants.API_FIELDS[operation]
-    ]
-    columns_string = ",".join(db_columns)
+    sql = get_create_table_sql(operation, table_name)
+    table_created = query_azure_database(sql, environment)
+
+    if table_created:
+        _existing_tables.add((environment, table_name))
+        _typed_tables.add((environment, table_name))
+
+    return table_created
+
+
+def migrate_azure_sql_table(environment, operation, prefix=False):
+    """Migrates a table created with every column as nvarchar(200) to the operation's TABLE_SCHEMAS
+
+    The existing table is renamed with a '_legacy' suffix and its rows are copied into a new typed table, keeping the most recent row for each primary key. Values that can't be converted are stored as NULL. The legacy table is kept so it can be checked and dropped manually.
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the table is for (Valid values libcal or vemcount)
+        prefix (bool, optional): Prefix for the database table name. Default is false
+
+    Returns:
+        bool: Flag to indicate success of the function, True if the table is already typed
+    """
+    table_name = shared_constants.DB_TABLE_NAMES[operation]
+    if prefix:
+        table_name = f"{prefix}_{table_name}"
+    legacy_table_name = f"{table_name}_legacy"
+
+    if (environment, table_name) in _typed_tables:
+        return True
+
+    table_schema = shared_constants.TABLE_SCHEMAS[operation]
+    clustered_index = table_schema["clustered_index"]
 
+    sql = """
+        SELECT DATA_TYPE
+        FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = ? AND COLUMN_NAME = ?
+    """
+    column_type = query_azure_database(
+        sql, environment, return_data=True, parameters=[table_name, clustered_index]
+    )
+    if column_type is False:
+        return False
+    if not column_type or column_type[0][0] != "nvarchar":
+        _typed_tables.add((environment, table_name))
+        return True
+
+    logging.info(f"Migrating {table_name} to typed columns")
+
+    fields = shared_constants.API_FIELDS[operation]
+    columns = ", ".join(f"[{field}]" for field in fields)
+    converted_columns = ", ".join(
+        f"[{field}]"
+        if table_schema["columns"][field].startswith("nvarchar")
+        else f"TRY_CONVERT({table_schema['columns'][field].split()[0]}, NULLIF([{field}], '')) AS [{field}]"
+        for field in fields
+    )
+    primary_key = ", ".join(f"[{key}]" for key in table_schema["primary_key"])
+    key_not_null = " AND ".join(
+        f"[{key}] IS NOT NULL" for key in table_schema["primary_key"]
+    )
+
+    # * Run as a single batch so the rename, create and copy are rolled back together if any of them fail
     sql = f"""
-        CREATE TABLE [dbo].[{table_name}] (
-            {columns_string}
+        EXEC sp_rename 'dbo.{table_name}', '{legacy_table_name}';
+        {get_create_table_sql(operation, table_name)}
+        INSERT INTO [dbo].[{table_name}] ({columns})
+        SELECT {columns}
+        FROM (
+            SELECT {columns},
+                ROW_NUMBER() OVER (PARTITION BY {primary_key} ORDER BY [{clustered_index}] DESC) AS [row_number]
+            FROM (
+                SELECT {converted_columns}
+                FROM [dbo].[{legacy_table_name}]
+            ) AS converted
+            WHERE {key_not_null}
+        ) AS deduplicated
+        WHERE [row_number] = 1
+    """
+    migrated = query_azure_database(sql, environment)
+
+    if migrated:
+        _typed_tables.add((environment, table_name))
+        logging.info(
+            f"{table_name} migrated, the original table has been kept as {legacy_table_name}"
         )
+
+    return migrated
+
+
+def convert_column(values, convert):
+    """Converts a column of values one at a time, so a value that can't be converted doesn't stop the rest of the column
+
+    Args:
+        values (iterable): Values to convert
+        convert (function): Called with each value that isn't empty
+
+    Returns:
+        list: Converted values, None for empty values and values that could not be converted
+        int: Number of values that could not be converted
+    """
+    converted = []
+    failures = 0
+    for value in values:
+        if value in ("", None):
+            converted.append(None)
+            continue
+        try:
+            converted.append(convert(value))
+        except (TypeError, ValueError):
+            converted.append(None)
+            failures += 1
+
+    return converted, failures
+
+
+def format_columns_for_table(columns, operation):
+    """Converts columns of values from an API response into the types of the operation's TABLE_SCHEMAS columns
+
+    Empty strings become NULL for int and date columns, rather than 0 or 1900-01-01. datetime2 columns are parsed with shared_dates, datetimeoffset columns are left as ISO strings for SQL Server to convert as pyodbc can't bind timezone aware values. Values that can't be converted are stored as NULL and counted in a warning, as migrate_azure_sql_table() does with TRY_CONVERT. If the column doesn't allow NULLs the row is then rejected by the load.
+
+    Args:
+        columns (list): One iterable of values per field, in API_FIELDS order
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+
+    Returns:
+        list: The converted columns, in API_FIELDS order
+    """
+    table_columns = shared_constants.TABLE_SCHEMAS[operation]["columns"]
+    columns = list(columns)
+
+    for column_number, field in enumerate(shared_constants.API_FIELDS[operation]):
+        column_type = table_columns[field]
+        failures = 0
+        if column_type.startswith("int"):
+            columns[column_number], failures = convert_column(
+                columns[column_number], int
+            )
+        elif column_type.startswith("datetime2"):
+            columns[column_number], failures = convert_column(
+                columns[column_number],
+                lambda value: shared_dates.parse_timestamp(value, operation),
+            )
+        elif column_type.startswith("datetimeoffset"):
+            columns[column_number] = [
+                None if value == "" else value for value in columns[column_number]
+            ]
+
+        if failures:
+            logging.warning(
+                f"{failures} {operation} {field} values could not be converted to {column_type.split()[0]} and have been set to NULL"
+            )
+
+    return columns
+
+
+def format_rows_for_table(data_for_upload, operation):
+    """Converts rows formatted from an API response into the types of the operation's TABLE_SCHEMAS columns, see format_columns_for_table()
+
+    Args:
+        data_for_upload (list): formatted list of data for upload to Azure
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+
+    Returns:
+        list: One tuple per row with values in API_FIELDS order
     """
-    return query_azure_database(sql, environment)
+    if not data_for_upload:
+        return []
+
+    return list(zip(*format_columns_for_table(zip(*data_for_upload), operation)))
 
 
 def get_most_recent_date_in_db(environment, operation, date_column, prefix=False):
@@ -162,47 +604,932 @@ def get_most_recent_date_in_db(environment, operation, date_column, prefix=False
     return top_date_in_db[0][0]
 
 
-def bulk_upload_azure_database(data_for_upload, environment, operation, prefix=False):
+def create_watermark_table(environment):
+    """Creates the watermark table, which records how far each operation has been loaded, if it does not already exist
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+
+    Returns:
+        bool: Flag to indicate success of the function
+    """
+    table_name = shared_constants.WATERMARK_TABLE_NAME
+
+    if (environment, table_name) in _existing_tables:
+        return True
+
+    sql = f"""
+        IF OBJECT_ID(N'[dbo].[{table_name}]', N'U') IS NULL
+        CREATE TABLE [dbo].[{table_name}] (
+            [operation] [nvarchar](50) NOT NULL,
+            [environment] [nvarchar](10) NOT NULL,
+            [watermark] [date] NOT NULL,
+            [updated_at] [datetime2] NOT NULL,
+            CONSTRAINT [PK_{table_name}] PRIMARY KEY ([operation], [environment])
+        )
+    """
+    table_created = query_azure_database(sql, environment)
+
+    if table_created:
+        _existing_tables.add((environment, table_name))
+
+    return table_created
+
+
+def get_watermark(environment, operation):
+    """Retrieves the date an operation has been loaded up to, as recorded with its last committed batch
+
+    This is a primary key lookup, so it costs the same however large the data tables grow
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation to look up (Valid values libcal or vemcount)
+
+    Returns:
+        bool: False flag if no watermark has been recorded or it could not be retrieved
+        date: The recorded watermark
+    """
+    if not create_watermark_table(environment):
+        return False
+
+    sql = f"""
+        SELECT [watermark]
+        FROM [dbo].[{shared_constants.WATERMARK_TABLE_NAME}]
+        WHERE [operation] = ? AND [environment] = ?
+    """
+    watermark = query_azure_database(
+        sql, environment, return_data=True, parameters=[operation, environment]
+    )
+
+    if not watermark:
+        logging.info(f"No watermark recorded for {operation} in {environment}")
+        return False
+
+    return shared_dates.parse_date(watermark[0][0])
+
+
+def get_save_watermark_sql():
+    """Builds the parameterised statement that records an operation's watermark, taking the operation, environment and watermark as parameters
+
+    Returns:
+        str: MERGE statement
+    """
+    return f"""
+        MERGE [dbo].[{shared_constants.WATERMARK_TABLE_NAME}] WITH (HOLDLOCK) AS target
+        USING (SELECT ? AS [operation], ? AS [environment], ? AS [watermark]) AS source
+        ON target.[operation] = source.[operation]
+        AND target.[environment] = source.[environment]
+        WHEN MATCHED
+            THEN UPDATE SET [watermark] = source.[watermark], [updated_at] = SYSUTCDATETIME()
+        WHEN NOT MATCHED
+            THEN INSERT ([operation], [environment], [watermark], [updated_at])
+            VALUES (source.[operation], source.[environment], source.[watermark], SYSUTCDATETIME());
+    """
+
+
+def save_watermark(environment, operation, watermark):
+    """Records the date an operation has been loaded up to, in a single atomic statement
+
+    Loads should pass their watermark to bulk_upload_azure_database or upsert_azure_database instead, so it is saved in the same transaction as the data
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation to record (Valid values libcal or vemcount)
+        watermark (date): Date the operation's data has been committed up to
+
+    Returns:
+        bool: Flag to indicate success of the function
+    """
+    if not create_watermark_table(environment):
+        return False
+
+    watermark_saved = query_azure_database(
+        get_save_watermark_sql(),
+        environment,
+        parameters=[operation, environment, watermark],
+    )
+
+    if watermark_saved:
+        logging.info(f"Watermark for {operation} saved: {watermark}")
+
+    return watermark_saved
+
+
+def create_reject_table(environment):
+    """Creates the table rows rejected by a load are kept in, if it does not already exist
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+
+    Returns:
+        bool: Flag to indicate success of the function
+    """
+    table_name = shared_constants.REJECT_TABLE_NAME
+
+    if (environment, table_name) in _existing_tables:
+        return True
+
+    sql = f"""
+        IF OBJECT_ID(N'[dbo].[{table_name}]', N'U') IS NULL
+        CREATE TABLE [dbo].[{table_name}] (
+            [id] [bigint] IDENTITY(1, 1) NOT NULL,
+            [operation] [nvarchar](50) NOT NULL,
+            [environment] [nvarchar](10) NOT NULL,
+            [table_name] [nvarchar](128) NOT NULL,
+            [row_data] [nvarchar](max) NOT NULL,
+            [error] [nvarchar](max) NOT NULL,
+            [rejected_at] [datetime2] NOT NULL,
+            CONSTRAINT [PK_{table_name}] PRIMARY KEY ([id])
+        )
+    """
+    table_created = query_azure_database(sql, environment)
+
+    if table_created:
+        _existing_tables.add((environment, table_name))
+
+    return table_created
+
+
+def get_save_rejects_sql():
+    """Builds the parameterised statement that records a rejected row, taking the operation, environment, table name, the row as JSON and the error as parameters
+
+    Returns:
+        str: INSERT statement
+    """
+    return f"""
+        INSERT INTO [dbo].[{shared_constants.REJECT_TABLE_NAME}]
+            ([operation], [environment], [table_name], [row_data], [error], [rejected_at])
+        VALUES (?, ?, ?, ?, ?, SYSUTCDATETIME())
+    """
+
+
+def get_insert_sql(operation, table_name):
+    """Builds the parameterised INSERT statement for an operation's API_FIELDS
+
+    Args:
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        table_name (str): Name of the table, including any prefix
+
+    Returns:
+        str: INSERT statement with one placeholder per field
+    """
+    columns = ", ".join(shared_constants.API_FIELDS[operation])
+    placeholders = ", ".join("?" for _ in shared_constants.API_FIELDS[operation])
+
+    return f"INSERT INTO [{table_name}] ({columns}) VALUES ({placeholders})"
+
+
+def get_partition_range(rows, operation):
+    """Finds the range of the operation's clustered index column covered by a partition from shared_helpers.partition_rows()
+
+    Args:
+        rows (list): Rows sorted on the clustered index column, with NULLs last
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+
+    Returns:
+        list: First and last value of the column, None if every value is NULL
+    """
+    column_index = shared_constants.API_FIELDS[operation].index(
+        shared_constants.TABLE_SCHEMAS[operation]["clustered_index"]
+    )
+    if not rows or rows[0][column_index] is None:
+        return None
+
+    last = next(
+        row[column_index] for row in reversed(rows) if row[column_index] is not None
+    )
+    return [rows[0][column_index], last]
+
+
+def get_delete_range_sql(operation, table_name):
+    """Builds the parameterised DELETE statement for a range of the operation's clustered index column, taking the first and last value as parameters
+
+    Args:
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        table_name (str): Name of the table, including any prefix
+
+    Returns:
+        str: DELETE statement
+    """
+    column = shared_constants.TABLE_SCHEMAS[operation]["clustered_index"]
+
+    return f"DELETE FROM [dbo].[{table_name}] WHERE [{column}] >= ? AND [{column}] <= ?"
+
+
+def is_duplicate_key_error(error):
+    """Checks if a database error was raised by a primary key or unique index violation, i.e. the row has already been loaded
+
+    Args:
+        error (pyodbc.Error): The error raised
+
+    Returns:
+        bool: True for SQL Server errors 2627 and 2601
+    """
+    message = str(error)
+    return "(2627)" in message or "(2601)" in message
+
+
+def insert_batch(
+    con,
+    cursor,
+    sql,
+    batch,
+    bisect_failures=True,
+    watermark_parameters=None,
+    reject_parameters=None,
+):
+    """Inserts and commits a batch of rows. If the batch fails because of the rows in it (an integrity or data error) it can be split in half repeatedly until the rows causing the failure are isolated. Any other error, e.g. a missing table or column, is raised.
+
+    Rejected rows are written to the REJECT_TABLE_NAME table with the error, in the same transaction as the watermark if it is due to be saved with them.
+
+    Args:
+        con (pyodbc.Connection): Open database connection
+        cursor (pyodbc.Cursor): Cursor on con, with fast_executemany enabled
+        sql (str): Parameterised INSERT statement
+        batch (list): Rows to insert
+        bisect_failures (bool, optional): Split a failed batch to isolate the bad rows, rather than rejecting the whole batch. Defaults to True.
+        watermark_parameters (list, optional): Operation, environment and watermark to save in the same transaction as the batch. If the batch is bisected it is saved with the final part, unless SQL_REJECT_STRICT is set and rows were rejected. Defaults to None.
+        reject_parameters (list, optional): Operation, environment and table name recorded with rejected rows. If not given rejected rows are only logged. Defaults to None.
+
+    Raises:
+        pyodbc.Error: If the batch failed for a reason other than the rows in it
+
+    Returns:
+        dict: Number of rows 'inserted', 'rejected' and 'skipped' because they were already loaded, and whether the 'watermark_saved'
+    """
+    import pyodbc
+
+    batch_counts = {
+        "inserted": 0,
+        "rejected": 0,
+        "skipped": 0,
+        "watermark_saved": False,
+    }
+
+    try:
+        cursor.executemany(sql, batch)
+        if watermark_parameters:
+            cursor.execute(get_save_watermark_sql(), watermark_parameters)
+        con.commit()
+        batch_counts["inserted"] = len(batch)
+        batch_counts["watermark_saved"] = bool(watermark_parameters)
+        return batch_counts
+    except (pyodbc.IntegrityError, pyodbc.DataError) as e:
+        con.rollback()
+        if len(batch) == 1 and is_duplicate_key_error(e):
+            batch_counts["skipped"] = 1
+            return batch_counts
+        if len(batch) == 1 or not bisect_failures:
+            batch_counts["rejected"] = len(batch)
+            if not reject_parameters:
+                for row in batch:
+                    logging.error(f"Row rejected: {e}. Row: {row}")
+                return batch_counts
+
+            logging.error(
+                f"{len(batch)} row(s) rejected and saved to {shared_constants.REJECT_TABLE_NAME}: {e}. First row: {batch[0]}"
+            )
+            cursor.executemany(
+                get_save_rejects_sql(),
+                [
+                    [*reject_parameters, json.dumps(list(row), default=str), str(e)]
+                    for row in batch
+                ],
+            )
+            if watermark_parameters and not shared_constants.SQL_REJECT_STRICT:
+                cursor.execute(get_save_watermark_sql(), watermark_parameters)
+                batch_counts["watermark_saved"] = True
+            con.commit()
+            return batch_counts
+
+    middle = len(batch) // 2
+    first_counts = insert_batch(
+        con,
+        cursor,
+        sql,
+        batch[:middle],
+        bisect_failures,
+        reject_parameters=reject_parameters,
+    )
+    second_counts = insert_batch(
+        con,
+        cursor,
+        sql,
+        batch[middle:],
+        bisect_failures,
+        None
+        if first_counts["rejected"] and shared_constants.SQL_REJECT_STRICT
+        else watermark_parameters,
+        reject_parameters,
+    )
+
+    for count in ("inserted", "rejected", "skipped"):
+        batch_counts[count] = first_counts[count] + second_counts[count]
+    batch_counts["watermark_saved"] = second_counts["watermark_saved"]
+
+    return batch_counts
+
+
+def write_csv_file(rows, operation, file_path):
+    """Writes rows formatted by format_rows_for_table() to a UTF-8 CSV file for BULK INSERT
+
+    The columns are written in the order of the operation's TABLE_SCHEMAS, which is the column order of the tables created by create_azure_sql_table(). NULLs are written as empty fields.
+
+    Args:
+        rows (list): Rows with values in API_FIELDS order
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        file_path (str): Path of the file to write
+    """
+    fields = shared_constants.API_FIELDS[operation]
+    column_indexes = [
+        fields.index(column)
+        for column in shared_constants.TABLE_SCHEMAS[operation]["columns"]
+    ]
+
+    with open(file_path, "w", encoding="utf-8", newline="") as csv_file:
+        writer = csv.writer(csv_file, lineterminator="\n")
+        writer.writerows([row[index] for index in column_indexes] for row in rows)
+
+
+def stage_file(file_path, blob_name):
+    """Copies a file to the BULK_LOAD_CONTAINER container in the data lake, unless BULK_LOAD_LOCAL_DIRECTORY is set in which case the file is already staged
+
+    Args:
+        file_path (str): Path of the local file
+        blob_name (str): Name of the blob to create
+
+    Returns:
+        str: Path of the staged file as BULK INSERT needs to reference it
+    """
+    from azure.storage.blob import BlobServiceClient
+
+    if shared_constants.BULK_LOAD_LOCAL_DIRECTORY:
+        return file_path
+
+    blob_client = BlobServiceClient(
+        account_url, credential=get_credential("azure")
+    ).get_blob_client(shared_constants.BULK_LOAD_CONTAINER, blob_name)
+    with open(file_path, "rb") as staged_file:
+        blob_client.upload_blob(staged_file, overwrite=True)
+
+    return blob_name
+
+
+def remove_staged_file(file_path, blob_name):
+    """Deletes a file staged by stage_file() along with the local copy
+
+    Args:
+        file_path (str): Path of the local file
+        blob_name (str): Name of the staged blob
+    """
+    from azure.storage.blob import BlobServiceClient
+
+    try:
+        if not shared_constants.BULK_LOAD_LOCAL_DIRECTORY:
+            BlobServiceClient(
+                account_url, credential=get_credential("azure")
+            ).get_blob_client(
+                shared_constants.BULK_LOAD_CONTAINER, blob_name
+            ).delete_blob()
+        os.remove(file_path)
+    except Exception as e:
+        logging.warning(f"Could not remove staged file {blob_name}: {e}")
+
+
+def bulk_insert_from_file(
+    rows,
+    environment,
+    operation,
+    table_name,
+    watermark=None,
+    table_lock=True,
+    replace_range=None,
+):
+    """Loads rows into a table with a single set-based BULK INSERT from a CSV file staged in the data lake
+
+    The rows and the watermark are committed in one transaction, so a failed load leaves the table unchanged.
+
+    Args:
+        rows (list): Rows formatted by format_rows_for_table()
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        table_name (str): Name of the table to load, including any prefix
+        watermark (date, optional): Saved as the operation's watermark in the same transaction as the load. Defaults to None.
+        table_lock (bool, optional): Load with TABLOCK, which is quicker for a single load but blocks any other load into the table until it commits. Defaults to True.
+        replace_range (list, optional): First and last value of the clustered index column, the rows already in this range are deleted in the same transaction before the load. Defaults to None.
+
+    Returns:
+        bool: Flag to indicate success of the function
+    """
+    blob_name = f"{environment}/{table_name}/{uuid.uuid4().hex}.csv"
+    file_path = os.path.join(
+        shared_constants.BULK_LOAD_LOCAL_DIRECTORY or tempfile.gettempdir(),
+        f"{table_name}_{uuid.uuid4().hex}.csv",
+    )
+
+    bulk_insert_options = "FORMAT = 'CSV', CODEPAGE = '65001', FIELDTERMINATOR = ',', ROWTERMINATOR = '0x0a', KEEPNULLS"
+    if table_lock:
+        bulk_insert_options = f"{bulk_insert_options}, TABLOCK"
+    if not shared_constants.BULK_LOAD_LOCAL_DIRECTORY:
+        bulk_insert_options = f"DATA_SOURCE = '{shared_constants.BULK_LOAD_DATA_SOURCE}', {bulk_insert_options}"
+
+    try:
+        started = time.perf_counter()
+        write_csv_file(rows, operation, file_path)
+        staged_path = stage_file(file_path, blob_name)
+        logging.info(
+            f"{len(rows)} rows staged for {table_name} in {time.perf_counter() - started:.2f}s"
+        )
+
+        with get_connection(environment) as con:
+            started = time.perf_counter()
+            cursor = con.cursor()
+            if replace_range:
+                cursor.execute(
+                    get_delete_range_sql(operation, table_name), replace_range
+                )
+            cursor.execute(
+                f"BULK INSERT [dbo].[{table_name}] FROM '{staged_path}' WITH ({bulk_insert_options})"
+            )
+            if watermark:
+                cursor.execute(
+                    get_save_watermark_sql(), [operation, environment, watermark]
+                )
+            con.commit()
+            elapsed_seconds = time.perf_counter() - started
+            record_sql_metric("query", elapsed_seconds)
+    except Exception as e:
+        logging.error(
+            f"Could not load {table_name} from a staged file. Here is the exception returned: {e}"
+        )
+        return False
+    finally:
+        remove_staged_file(file_path, blob_name)
+
+    logging.info(
+        f"Success: {len(rows)} rows added to {table_name} by BULK INSERT at {len(rows) / max(elapsed_seconds, 1e-6):.0f} rows/s"
+    )
+    return True
+
+
+def log_rejected_rows(upload_counts, table_name):
+    """Logs the rows a load skipped and rejected, and checks whether the load can still succeed
+
+    Args:
+        upload_counts (dict): Number of rows 'inserted', 'rejected' and 'skipped'
+        table_name (str): Name of the table loaded, including any prefix
+
+    Returns:
+        bool: False if rows were rejected and SQL_REJECT_STRICT is set
+    """
+    if upload_counts["skipped"]:
+        logging.info(
+            f"{upload_counts['skipped']} rows were already in {table_name} and skipped"
+        )
+    if not upload_counts["rejected"]:
+        return True
+
+    if shared_constants.SQL_REJECT_STRICT:
+        logging.error(
+            f"{upload_counts['rejected']} rows rejected by {table_name} and saved to {shared_constants.REJECT_TABLE_NAME}, the watermark has not been saved"
+        )
+        return False
+
+    logging.warning(
+        f"{upload_counts['rejected']} rows rejected by {table_name} and saved to {shared_constants.REJECT_TABLE_NAME}, the rest of the load has been committed"
+    )
+    return True
+
+
+def bulk_upload_azure_database(
+    data_for_upload,
+    environment,
+    operation,
+    prefix=False,
+    batch_size=None,
+    watermark=None,
+    formatted=False,
+):
     """Upload list of lists to Azure SQL database
 
+    Rows are sent in batches using pyodbc's fast_executemany array binding and each batch is committed separately. A batch that fails because of its rows is bisected to isolate them, rows that are already in the table are skipped and rows the table rejects are saved to the REJECT_TABLE_NAME table. Uploads of at least BULK_LOAD_MIN_ROWS rows are loaded from a staged file by bulk_insert_from_file() instead, falling back to batches if the file load fails.
+
     Args:
         data_for_upload (list): formatted list of data for upload to Azure
         environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
         prefix (bool, optional): Prefix for the database table name to check. Default is false
+        batch_size (int, optional): Number of rows per batch. Defaults to SQL_UPLOAD_BATCH_SIZE.
+        watermark (date, optional): Saved as the operation's watermark in the same transaction as the final batch. Defaults to None.
+        formatted (bool, optional): The rows have already been converted by format_columns_for_table(). Defaults to False.
 
     Returns:
-        bool: Flag to indicate success of the function
+        bool: False flag to indicate the upload failed, or if SQL_REJECT_STRICT is set and rows were rejected in which case the watermark is not saved
+        dict: Number of rows 'inserted', 'rejected' and 'skipped' because they were already loaded
     """
     table_name = shared_constants.DB_TABLE_NAMES[operation]
     if prefix:
         table_name = f"{prefix}_{table_name}"
 
+    if batch_size is None:
+        batch_size = shared_constants.SQL_UPLOAD_BATCH_SIZE
+
     logging.info(
         f"{len(data_for_upload)} rows to be added to {table_name} in {environment} database"
     )
+    if not formatted:
+        data_for_upload = format_rows_for_table(data_for_upload, operation)
 
-    columns = ", ".join(shared_constants.API_FIELDS[operation])
-    placeholders = "?, " * len(shared_constants.API_FIELDS[operation])
-    placeholders = placeholders[:-2]
+    sql = get_insert_sql(operation, table_name)
+    upload_counts = {"inserted": 0, "rejected": 0, "skipped": 0}
+    reject_parameters = [operation, environment, table_name]
+    watermark_saved = False
+
+    if watermark and not create_watermark_table(environment):
+        return False
+
+    # * There's no batch to save the watermark with, but the window still needs to be marked as loaded
+    if watermark and not data_for_upload:
+        return save_watermark(environment, operation, watermark) and upload_counts
+
+    if 0 < shared_constants.BULK_LOAD_MIN_ROWS <= len(data_for_upload):
+        if bulk_insert_from_file(
+            data_for_upload, environment, operation, table_name, watermark
+        ):
+            upload_counts["inserted"] = len(data_for_upload)
+            return upload_counts
+        logging.warning(f"Falling back to batched inserts for {table_name}")
+
+    if not create_reject_table(environment):
+        return False
 
-    sql = f"INSERT INTO [{table_name}] ({columns}) VALUES ({placeholders})"
-    username = os.environ.get("SQL_ADMIN_USER")
-    password = os.environ.get("SQL_ADMIN_PASSWORD")
-    connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:slv-{environment}-sqldw.database.windows.net,1433;Database={environment}-edw;Uid={username};Pwd={{{password}}};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
     try:
-        con = pyodbc.connect(connection_string)
+        with get_connection(environment) as con:
+            cursor = con.cursor()
+            cursor.fast_executemany = True
+            for batch_start in range(0, len(data_for_upload), batch_size):
+                batch = data_for_upload[batch_start : batch_start + batch_size]
+                watermark_parameters = None
+                if (
+                    watermark
+                    and not (
+                        upload_counts["rejected"] and shared_constants.SQL_REJECT_STRICT
+                    )
+                    and batch_start + batch_size >= len(data_for_upload)
+                ):
+                    watermark_parameters = [operation, environment, watermark]
+
+                started = time.perf_counter()
+                batch_counts = insert_batch(
+                    con,
+                    cursor,
+                    sql,
+                    batch,
+                    watermark_parameters=watermark_parameters,
+                    reject_parameters=reject_parameters,
+                )
+                elapsed_seconds = time.perf_counter() - started
+                record_sql_metric("query", elapsed_seconds)
+
+                for count in upload_counts:
+                    upload_counts[count] += batch_counts[count]
+                watermark_saved = batch_counts["watermark_saved"]
+                logging.info(
+                    f"Batch of {len(batch)} rows committed to {table_name} at {len(batch) / max(elapsed_seconds, 1e-6):.0f} rows/s"
+                )
+    except Exception as e:
+        logging.error(
+            f"Could not complete sql query after {upload_counts['inserted']} rows were added. Here is the exception returned: {e}"
+        )
+        return False
+
+    if not log_rejected_rows(upload_counts, table_name):
+        return False
+
+    # * The final batch's watermark is lost if its last row was already loaded
+    if watermark and not watermark_saved:
+        if not save_watermark(environment, operation, watermark):
+            return False
+
+    logging.info(f"Success: {upload_counts['inserted']} rows added to {table_name}")
+    return upload_counts
+
+
+def load_partition(rows, environment, operation, table_name):
+    """Loads one partition of rows over its own connection and commits it as a single transaction
+
+    The rows already in the partition's key range, e.g. committed by an earlier run that stopped before the watermark was saved, are deleted in the same transaction, so a partition can be loaded again without hitting the primary key. Partitions of at least BULK_LOAD_MIN_ROWS rows are loaded from a staged file. Otherwise the rows are sent in SQL_UPLOAD_BATCH_SIZE batches and committed together. If the transaction fails because of its rows it is rolled back, the range is cleared on its own and the rows are reloaded in bisected batches by insert_batch(), which saves any rows the table rejects to the REJECT_TABLE_NAME table. Any other error is raised.
+
+    Args:
+        rows (list): Rows formatted by format_rows_for_table()
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        table_name (str): Name of the table to load, including any prefix
+
+    Raises:
+        pyodbc.Error: If the partition failed for a reason other than the rows in it
+
+    Returns:
+        dict: Number of rows 'inserted', 'rejected' and 'skipped' because they were already loaded, and the 'seconds' taken
+    """
+    import pyodbc
+
+    started = time.perf_counter()
+    batch_size = shared_constants.SQL_UPLOAD_BATCH_SIZE
+    replace_range = get_partition_range(rows, operation)
+    delete_sql = get_delete_range_sql(operation, table_name)
+
+    if 0 < shared_constants.BULK_LOAD_MIN_ROWS <= len(rows):
+        # * Partitions are loaded side by side, a table lock would make them wait for each other
+        if bulk_insert_from_file(
+            rows,
+            environment,
+            operation,
+            table_name,
+            table_lock=False,
+            replace_range=replace_range,
+        ):
+            return {
+                "inserted": len(rows),
+                "rejected": 0,
+                "skipped": 0,
+                "seconds": time.perf_counter() - started,
+            }
+
+    sql = get_insert_sql(operation, table_name)
+    partition_counts = {"inserted": 0, "rejected": 0, "skipped": 0}
+
+    with get_connection(environment) as con:
         cursor = con.cursor()
-        cursor.executemany(sql, data_for_upload)
-        con.commit()
-        con.close()
-        logging.info(f"Success: {len(data_for_upload)} rows added to {table_name}")
-        return True
+        cursor.fast_executemany = True
+        try:
+            if replace_range:
+                cursor.execute(delete_sql, replace_range)
+            for batch_start in range(0, len(rows), batch_size):
+                cursor.executemany(sql, rows[batch_start : batch_start + batch_size])
+            con.commit()
+            partition_counts["inserted"] = len(rows)
+        except (pyodbc.IntegrityError, pyodbc.DataError) as e:
+            con.rollback()
+            logging.warning(
+                f"Partition of {len(rows)} rows could not be committed to {table_name}, retrying in batches: {e}"
+            )
+            # * The batches are committed separately, so the range is cleared first or a rerun would collide with them
+            if replace_range:
+                cursor.execute(delete_sql, replace_range)
+                con.commit()
+            for batch_start in range(0, len(rows), batch_size):
+                batch_counts = insert_batch(
+                    con,
+                    cursor,
+                    sql,
+                    rows[batch_start : batch_start + batch_size],
+                    reject_parameters=[operation, environment, table_name],
+                )
+                for count in partition_counts:
+                    partition_counts[count] += batch_counts[count]
+
+    elapsed_seconds = time.perf_counter() - started
+    record_sql_metric("query", elapsed_seconds)
+    partition_counts["seconds"] = elapsed_seconds
+
+    return partition_counts
+
+
+def partitioned_upload_azure_database(
+    data_for_upload,
+    environment,
+    operation,
+    prefix=False,
+    parallelism=None,
+    watermark=None,
+    formatted=False,
+):
+    """Upload list of lists to Azure SQL database over several connections at once
+
+    The rows are split into key ranges on the operation's clustered index column, so each connection writes to a separate range of the table, and each partition replaces its range in a single transaction by load_partition(). The watermark is only saved once every partition has been committed, in a transaction of its own.
+
+    Args:
+        data_for_upload (list): formatted list of data for upload to Azure
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        prefix (bool, optional): Prefix for the database table name to check. Default is false
+        parallelism (int, optional): Number of partitions loaded at once. Defaults to SQL_UPLOAD_PARALLELISM, and is capped at SQL_POOL_MAXSIZE.
+        watermark (date, optional): Saved as the operation's watermark once every partition has been committed. Defaults to None.
+        formatted (bool, optional): The rows have already been converted by format_columns_for_table(). Defaults to False.
+
+    Returns:
+        bool: False flag to indicate the upload failed, or if SQL_REJECT_STRICT is set and rows were rejected in which case the watermark is not saved
+        dict: Number of rows 'inserted', 'rejected' and 'skipped' because they were already loaded
+    """
+    if parallelism is None:
+        parallelism = shared_constants.SQL_UPLOAD_PARALLELISM
+    parallelism = min(parallelism, shared_constants.SQL_POOL_MAXSIZE)
+
+    # * Splitting isn't worth it if each connection would get less than one batch
+    if (
+        parallelism < 2
+        or len(data_for_upload) < 2 * shared_constants.SQL_UPLOAD_BATCH_SIZE
+    ):
+        return bulk_upload_azure_database(
+            data_for_upload,
+            environment,
+            operation,
+            prefix,
+            watermark=watermark,
+            formatted=formatted,
+        )
+
+    table_name = shared_constants.DB_TABLE_NAMES[operation]
+    if prefix:
+        table_name = f"{prefix}_{table_name}"
+
+    if watermark and not create_watermark_table(environment):
+        return False
+    if not create_reject_table(environment):
+        return False
+
+    partition_column = shared_constants.TABLE_SCHEMAS[operation]["clustered_index"]
+    column_index = shared_constants.API_FIELDS[operation].index(partition_column)
+    row_partitions = shared_helpers.partition_rows(
+        data_for_upload
+        if formatted
+        else format_rows_for_table(data_for_upload, operation),
+        column_index,
+        parallelism,
+    )
+
+    logging.info(
+        f"{len(data_for_upload)} rows to be added to {table_name} in {environment} database in {len(row_partitions)} partitions on {partition_column}"
+    )
+
+    started = time.perf_counter()
+    partition_results = []
+    try:
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = [
+                executor.submit(
+                    load_partition, rows, environment, operation, table_name
+                )
+                for rows in row_partitions
+            ]
+            for rows, future in zip(row_partitions, futures):
+                partition_result = future.result()
+                partition_result["from"] = rows[0][column_index]
+                partition_result["to"] = rows[-1][column_index]
+                partition_results.append(partition_result)
+    except Exception as e:
+        logging.error(
+            f"Could not complete sql query after {len(partition_results)} of {len(row_partitions)} partitions were added. Here is the exception returned: {e}"
+        )
+        return False
+    elapsed_seconds = time.perf_counter() - started
+
+    for partition_number, partition_result in enumerate(partition_results, 1):
+        logging.info(
+            f"Partition {partition_number} ({partition_result['from']} to {partition_result['to']}): {partition_result['inserted']} rows in {partition_result['seconds']:.2f}s at {partition_result['inserted'] / max(partition_result['seconds'], 1e-6):.0f} rows/s"
+        )
+    upload_counts = {
+        count: sum(result[count] for result in partition_results)
+        for count in ("inserted", "rejected", "skipped")
+    }
+    partition_seconds = sum(result["seconds"] for result in partition_results)
+    logging.info(
+        f"{len(partition_results)} partitions loaded in {elapsed_seconds:.2f}s, {partition_seconds:.2f}s of partition time ({partition_seconds / max(elapsed_seconds, 1e-6):.1f}x parallel speed-up)"
+    )
+
+    if not log_rejected_rows(upload_counts, table_name):
+        return False
+
+    if watermark and not save_watermark(environment, operation, watermark):
+        return False
+
+    logging.info(f"Success: {upload_counts['inserted']} rows added to {table_name}")
+    return upload_counts
+
+
+def upsert_azure_database(
+    data_for_upload, environment, operation, prefix=False, watermark=None
+):
+    """Upserts list of lists into an Azure SQL table, keyed on the primary key in the operation's TABLE_SCHEMAS
+
+    The rows are loaded into a temporary staging table and merged into the target table in a single set-based statement. Rows whose key is already present with identical values are left untouched.
+
+    Args:
+        data_for_upload (list): formatted list of data for upload to Azure
+        environment (str): Staging environment (Valid values dev, test or prod)
+        operation (str): Operation the data belongs to (Valid values libcal or vemcount)
+        prefix (bool, optional): Prefix for the database table name to check. Default is false
+        watermark (date, optional): Saved as the operation's watermark in the same transaction as the merge. Defaults to None.
+
+    Returns:
+        bool: False flag to indicate the upsert failed
+        dict: Number of rows 'inserted', 'updated' and 'skipped'
+    """
+    table_name = shared_constants.DB_TABLE_NAMES[operation]
+    if prefix:
+        table_name = f"{prefix}_{table_name}"
+    staging_table_name = f"#{table_name}_staging"
+
+    fields = shared_constants.API_FIELDS[operation]
+    keys = shared_constants.TABLE_SCHEMAS[operation]["primary_key"]
+
+    if watermark and not create_watermark_table(environment):
+        return False
+
+    columns = ", ".join(f"[{field}]" for field in fields)
+    source_columns = ", ".join(f"source.[{field}]" for field in fields)
+    target_columns = ", ".join(f"target.[{field}]" for field in fields)
+    placeholders = ", ".join("?" for _ in fields)
+    join_condition = " AND ".join(f"target.[{key}] = source.[{key}]" for key in keys)
+    update_columns = ", ".join(
+        f"target.[{field}] = source.[{field}]" for field in fields if field not in keys
+    )
+
+    create_staging_sql = f"SELECT TOP (0) {columns} INTO [{staging_table_name}] FROM [dbo].[{table_name}]"
+    insert_staging_sql = (
+        f"INSERT INTO [{staging_table_name}] ({columns}) VALUES ({placeholders})"
+    )
+    # * EXCEPT compares NULLs as equal, so unchanged rows are not rewritten
+    merge_sql = f"""
+        MERGE [dbo].[{table_name}] AS target
+        USING [{staging_table_name}] AS source
+        ON {join_condition}
+        WHEN MATCHED AND EXISTS (SELECT {source_columns} EXCEPT SELECT {target_columns})
+            THEN UPDATE SET {update_columns}
+        WHEN NOT MATCHED BY TARGET
+            THEN INSERT ({columns}) VALUES ({source_columns})
+        OUTPUT $action;
+    """
+
+    try:
+        # * MERGE fails if a key appears twice in the source, so only the last version of each row is kept
+        key_indexes = [fields.index(key) for key in keys]
+        rows_by_key = {
+            tuple(row[index] for index in key_indexes): row
+            for row in format_rows_for_table(data_for_upload, operation)
+        }
+        rows_to_merge = list(rows_by_key.values())
+
+        logging.info(
+            f"{len(rows_to_merge)} rows to be upserted into {table_name} in {environment} database"
+        )
+
+        with get_connection(environment) as con:
+            started = time.perf_counter()
+            cursor = con.cursor()
+            cursor.fast_executemany = True
+            cursor.execute(create_staging_sql)
+            cursor.executemany(insert_staging_sql, rows_to_merge)
+            cursor.execute(merge_sql)
+            merge_actions = [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"DROP TABLE [{staging_table_name}]")
+            if watermark:
+                cursor.execute(
+                    get_save_watermark_sql(), [operation, environment, watermark]
+                )
+            con.commit()
+            record_sql_metric("query", time.perf_counter() - started)
     except Exception as e:
         logging.error(
             f"Could not complete sql query. Here is the exception returned: {e}"
         )
         return False
 
+    upsert_counts = {
+        "inserted": merge_actions.count("INSERT"),
+        "updated": merge_actions.count("UPDATE"),
+    }
+    upsert_counts["skipped"] = (
+        len(data_for_upload) - upsert_counts["inserted"] - upsert_counts["updated"]
+    )
+    logging.info(
+        f"Success: {upsert_counts['inserted']} rows inserted, {upsert_counts['updated']} updated and {upsert_counts['skipped']} skipped in {table_name}"
+    )
+    return upsert_counts
+
+
+def get_sqlalchemy_engine(environment):
+    """Returns the environment's SQLAlchemy engine, created on first use and kept for the life of the Function instance
+
+    Args:
+        environment (str): Staging environment (Valid values dev, test or prod)
+
+    Returns:
+        sqlalchemy.engine.Engine: Engine whose connections are opened through the same connection string and metrics as the pyodbc pool
+    """
+    import sqlalchemy
+
+    with _connection_pools_lock:
+        if environment not in _sqlalchemy_engines:
+            _sqlalchemy_engines[environment] = sqlalchemy.create_engine(
+                "mssql+pyodbc://",
+                creator=lambda: _open_connection(environment),
+                pool_size=shared_constants.SQL_POOL_MAXSIZE,
+                pool_pre_ping=True,
+            )
+        return _sqlalchemy_engines[environment]
+
 
 def upload_dataframe_to_azure_database(dataframe, environment, operation, prefix=False):
     """_summary_
@@ -216,12 +1543,9 @@ def upload_dataframe_to_azure_database(dataframe, environment, operation, prefix
     Returns:
         _type_: _description_
     """
-    username = os.environ.get("SQL_ADMIN_USER")
-    password = os.environ.get("SQL_ADMIN_PASSWORD")
-    connection_string = f"Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:slv-{environment}-sqldw.database.windows.net,1433;Database={environment}-edw;Uid={username};Pwd={{{password}}};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
     try:
         table_name = shared_constants.DB_TABLE_NAMES[operation]
-        engine = sqlalchemy.create_engine(connection_string)
+        engine = get_sqlalchemy_engine(environment)
 
         dataframe.to_sql(table_name, engine)
         return True
@@ -232,34 +1556,13 @@ def upload_dataframe_to_azure_database(dataframe, environment, operation, prefix
 
 
 def authenticate_by_client_token():
+    """Retrieves an access token for the Power BI REST API using the Power BI service principal
 
-    tenant_id = os.environ.get("AZURE_TENANT_ID")
-    app_id = os.environ.get("PBI_APPLICATION_ID")
-    client_secret = os.environ.get("PBI_SECRET")
-    auth = "https://analysis.windows.net/powerbi/api/.default"
-
-    credentials = ClientSecretCredential(
-        authority="https://login.microsoftonline.com/",
-        tenant_id=tenant_id,
-        client_id=app_id,
-        client_secret=client_secret,
-    )
-
-    access_token = credentials.get_token(auth)
-    access_token = access_token.token
-
-    return access_token
+    Returns:
+        str: The access token, cached until shortly before it expires
+    """
+    return get_access_token("power_bi", shared_constants.POWER_BI_SCOPE)
 
 
 storage_account_name = "slvproddatalake"
 account_url = f"https://{storage_account_name}.blob.core.windows.net"
-
-azure_client_id = os.environ.get("AZURE_CLIENT_ID")
-azure_client_secret = os.environ.get("AZURE_CLIENT_SECRET")
-azure_tenant_id = os.environ.get("AZURE_TENANT_ID")
-
-credentials = ClientSecretCredential(
-    client_id=azure_client_id,
-    client_secret=azure_client_secret,
-    tenant_id=azure_tenant_id,
-)
@@ -1,9 +1,18 @@
+import os
+
 AZURE_VARIABLES = {
     "test": "https://slv-test-sqldw-kv.vault.azure.net/",
     "dev": "https://slv-dev-sqldw-kv.vault.azure.net/",
     "prod": "https://slv-prod-sqldw-kv.vault.azure.net/",
 }
 
+# * Environmental variables holding the tenant, client id and secret of each service principal used by shared_azure.get_credential()
+AZURE_CREDENTIALS = {
+    "azure": ("AZURE_TENANT_ID", "AZURE_CLIENT_ID", "AZURE_CLIENT_SECRET"),
+    "power_bi": ("AZURE_TENANT_ID", "PBI_APPLICATION_ID", "PBI_SECRET"),
+}
+POWER_BI_SCOPE = "https://analysis.windows.net/powerbi/api/.default"
+
 API_FIELDS = {
     "libcal": [
         "bookId",
@@ -21,4 +30,131 @@ API_FIELDS = {
 
 DB_TABLE_NAMES = {"libcal": "libcal_bookings", "vemcount": "vemcount"}
 
+# * Records how far each operation has been loaded, so restarts resume without scanning the data tables
+WATERMARK_TABLE_NAME = "etl_watermarks"
+
+# * Rows a load rejects are kept in this table with the error, so one bad row doesn't stop the watermark moving on. With SQL_REJECT_STRICT=1 a load with rejected rows fails instead and the window is retried on the next run
+REJECT_TABLE_NAME = "etl_rejected_rows"
+SQL_REJECT_STRICT = bool(int(os.environ.get("SQL_REJECT_STRICT", 0)))
+
+# * Column types, primary key and the column the tables are clustered on, which is also the column loads resume from
+TABLE_SCHEMAS = {
+    "libcal": {
+        "columns": {
+            "bookId": "nvarchar(50) NOT NULL",
+            "eid": "int NULL",
+            "location_name": "nvarchar(200) NULL",
+            "category_name": "nvarchar(200) NULL",
+            "item_name": "nvarchar(200) NULL",
+            "status": "nvarchar(50) NULL",
+            "fromDate": "datetimeoffset(0) NULL",
+            "toDate": "datetimeoffset(0) NULL",
+            "created": "datetimeoffset(0) NULL",
+        },
+        "primary_key": ["bookId"],
+        "clustered_index": "fromDate",
+    },
+    "vemcount": {
+        "columns": {
+            "zone_id": "int NOT NULL",
+            "dt": "datetime2(0) NOT NULL",
+            "count_in": "int NULL",
+            "count_out": "int NULL",
+            "inside": "int NULL",
+        },
+        "primary_key": ["zone_id", "dt"],
+        "clustered_index": "dt",
+    },
+}
+
 EARLIEST_DATE = "2020-01-01"
+
+# * Number of Vemcount zones requested at once for each date window
+VEMCOUNT_ZONE_CONCURRENCY = int(os.environ.get("VEMCOUNT_ZONE_CONCURRENCY", 8))
+
+# * Report windows start at VEMCOUNT_INITIAL_WINDOW_DAYS and are resized after each response, a zone has 48 rows per day at a 30min period_step
+VEMCOUNT_INITIAL_WINDOW_DAYS = 7
+VEMCOUNT_MAX_WINDOW_DAYS = int(os.environ.get("VEMCOUNT_MAX_WINDOW_DAYS", 92))
+VEMCOUNT_MAX_ROWS_PER_REQUEST = int(
+    os.environ.get("VEMCOUNT_MAX_ROWS_PER_REQUEST", 48 * 31)
+)
+VEMCOUNT_TARGET_REQUEST_SECONDS = float(
+    os.environ.get("VEMCOUNT_TARGET_REQUEST_SECONDS", 20)
+)
+# * Number of fetched windows allowed to wait for upload, 0 fetches and uploads one after the other
+VEMCOUNT_PIPELINE_DEPTH = int(os.environ.get("VEMCOUNT_PIPELINE_DEPTH", 2))
+
+# * Formats the API timestamps are returned in, used when a value is not ISO formatted
+TIMESTAMP_FORMATS = {
+    "libcal": "%Y-%m-%dT%H:%M:%S%z",
+    "vemcount": "%Y-%m-%d %H:%M:%S",
+}
+TIMESTAMP_CACHE_SIZE = 65536
+
+# * LibCal tokens are refreshed this many seconds before they expire
+LIBCAL_TOKEN_EXPIRY_MARGIN = 60
+LIBCAL_TOKEN_DEFAULT_EXPIRY = 3600
+
+# * Number of bookings pages requested from LibCal at once, keep this low enough to stay under LibCal's rate limits
+LIBCAL_PAGE_CONCURRENCY = int(os.environ.get("LIBCAL_PAGE_CONCURRENCY", 4))
+LIBCAL_PAGE_LIMIT = 500
+# * Rows are flushed to the database in batches of this size as they are retrieved
+LIBCAL_UPLOAD_BATCH_SIZE = int(os.environ.get("LIBCAL_UPLOAD_BATCH_SIZE", 5000))
+
+# * Outbound HTTP connection pools, the environmental variables allow these to be tuned per Function App
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 120))
+
+# * Azure SQL connections kept open per environment, idle connections are checked before reuse after SQL_POOL_HEALTH_CHECK_SECONDS
+SQL_POOL_MAXSIZE = int(os.environ.get("SQL_POOL_MAXSIZE", 4))
+SQL_POOL_TIMEOUT_SECONDS = float(os.environ.get("SQL_POOL_TIMEOUT_SECONDS", 60))
+SQL_POOL_HEALTH_CHECK_SECONDS = float(
+    os.environ.get("SQL_POOL_HEALTH_CHECK_SECONDS", 30)
+)
+
+# * Rows sent and committed per batch by bulk_upload_azure_database
+SQL_UPLOAD_BATCH_SIZE = int(os.environ.get("SQL_UPLOAD_BATCH_SIZE", 10000))
+
+# * ODBC type code for datetimeoffset columns, which pyodbc needs an output converter for
+SQL_DATETIMEOFFSET_TYPE = -155
+
+# * Uploads of at least BULK_LOAD_MIN_ROWS rows are written to a CSV file, staged in the data lake and loaded with BULK INSERT, 0 disables file loads
+BULK_LOAD_MIN_ROWS = int(os.environ.get("BULK_LOAD_MIN_ROWS", 50000))
+BULK_LOAD_CONTAINER = os.environ.get("BULK_LOAD_CONTAINER", "etl-staging")
+# * External data source in each database pointing at BULK_LOAD_CONTAINER, created with a database scoped credential
+BULK_LOAD_DATA_SOURCE = os.environ.get("BULK_LOAD_DATA_SOURCE", "etl_staging")
+# * When set, files are staged in this directory instead of blob storage, it must be readable by the SQL Server e.g. a volume mounted into a local container
+BULK_LOAD_LOCAL_DIRECTORY = os.environ.get("BULK_LOAD_LOCAL_DIRECTORY")
+
+# * Number of key range partitions loaded at once by partitioned_upload_azure_database, capped at SQL_POOL_MAXSIZE
+SQL_UPLOAD_PARALLELISM = int(os.environ.get("SQL_UPLOAD_PARALLELISM", 4))
+
+# * Key Vault secrets are cached for KEY_VAULT_SECRET_TTL_SECONDS, AAD access tokens are refreshed AZURE_TOKEN_REFRESH_MARGIN seconds before they expire
+KEY_VAULT_SECRET_TTL_SECONDS = int(os.environ.get("KEY_VAULT_SECRET_TTL_SECONDS", 3600))
+AZURE_TOKEN_REFRESH_MARGIN = 300
+
+# * Number of Power BI API requests made at once, and how 429 responses without a usable Retry-After header are retried
+POWER_BI_CONCURRENCY = int(os.environ.get("POWER_BI_CONCURRENCY", 8))
+POWER_BI_MAX_RETRIES = 5
+POWER_BI_DEFAULT_RETRY_AFTER = 10
+POWER_BI_MAX_RETRY_AFTER = 120
+
+# * Only the most recent POWER_BI_REFRESH_HISTORY_TOP refreshes of each dataset are reported on. Each run first requests POWER_BI_REFRESH_PROBE_TOP refreshes, and only requests the full window if none of them have been seen before
+POWER_BI_REFRESH_HISTORY_TOP = int(os.environ.get("POWER_BI_REFRESH_HISTORY_TOP", 30))
+POWER_BI_REFRESH_PROBE_TOP = 5
+# * Refresh histories already retrieved, on Azure the HOME directory is kept between instances and restarts
+POWER_BI_REFRESH_CACHE_PATH = os.environ.get(
+    "POWER_BI_REFRESH_CACHE_PATH",
+    os.path.join(
+        os.environ.get("HOME", os.path.expanduser("~")),
+        "power_bi_refresh_cache.json",
+    ),
+)
+
+# * Async HTTP fan-out in shared_helpers, requests failing with a RETRY_STATUSES code, a timeout or a connection error are retried with jittered exponential backoff
+ASYNC_HTTP_CONCURRENCY = int(os.environ.get("ASYNC_HTTP_CONCURRENCY", 10))
+ASYNC_HTTP_TIMEOUT_SECONDS = float(os.environ.get("ASYNC_HTTP_TIMEOUT_SECONDS", 60))
+ASYNC_HTTP_MAX_RETRIES = 3
+ASYNC_HTTP_BACKOFF_SECONDS = 1
+ASYNC_HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
@@ -0,0 +1,87 @@
+from datetime import date, datetime
+from functools import lru_cache
+
+from . import shared_constants
+
+
+@lru_cache(maxsize=shared_constants.TIMESTAMP_CACHE_SIZE)
+def _parse_iso_timestamp(value):
+    return datetime.fromisoformat(value)
+
+
+@lru_cache(maxsize=shared_constants.TIMESTAMP_CACHE_SIZE)
+def _parse_iso_date(value):
+    return date.fromisoformat(value)
+
+
+def parse_timestamp(value, operation):
+    """Converts a timestamp returned by an API or the database into a datetime
+
+    ISO formatted strings are parsed with the C implemented datetime.fromisoformat, the results are cached as the same timestamps repeat across zones and reruns. Anything else falls back to the operation's format in TIMESTAMP_FORMATS.
+
+    Args:
+        value (str): The timestamp to parse, datetime and date values are passed through
+        operation (str): Operation the timestamp belongs to (Valid values libcal or vemcount)
+
+    Returns:
+        datetime: The parsed timestamp
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+
+    try:
+        return _parse_iso_timestamp(value)
+    except ValueError:
+        return datetime.strptime(value, shared_constants.TIMESTAMP_FORMATS[operation])
+
+
+def parse_timestamp_column(values, operation):
+    """Converts a whole column of timestamps into datetimes, see parse_timestamp()
+
+    Args:
+        values (iterable): The timestamps to parse
+        operation (str): Operation the timestamps belong to (Valid values libcal or vemcount)
+
+    Returns:
+        list: The parsed timestamps, in the same order as values
+    """
+    return [parse_timestamp(value, operation) for value in values]
+
+
+def parse_date(value):
+    """Returns the date part of a timestamp, only the leading YYYY-MM-DD characters of a string are parsed
+
+    Args:
+        value (str): The timestamp to parse, datetime and date values are passed through
+
+    Returns:
+        date: The date the timestamp falls on, in the timestamp's own timezone
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+
+    return _parse_iso_date(value[:10])
+
+
+def get_max_date(values):
+    """Returns the most recent date in a column of ISO formatted timestamps
+
+    The YYYY-MM-DD prefixes sort in date order as strings, so they are compared directly and only the largest is parsed
+
+    Args:
+        values (iterable): ISO formatted timestamp strings
+
+    Returns:
+        bool: False if values is empty
+        date: The most recent date in values
+    """
+    max_value = max((value[:10] for value in values), default=False)
+
+    if not max_value:
+        return False
+
+    return _parse_iso_date(max_value)
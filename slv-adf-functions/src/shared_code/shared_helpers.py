@@ -1,10 +1,14 @@
-import asyncio
 import csv
 import logging
 import os
+import queue
+import random
+import threading
+import time
+from itertools import islice
+from operator import itemgetter
 
-import aiohttp
-import psycopg2
+from . import shared_constants
 
 
 def query_database(sql_statement, return_data=False):
@@ -18,6 +22,8 @@ def query_database(sql_statement, return_data=False):
         bool: Will return True/False flag to indicate that the SQL statement was successfully run
         list: Data returned from the database
     """
+    import psycopg2
+
     host = os.environ.get("DB_HOST")
     dbname = os.environ.get("DB_NAME")
     user = os.environ.get("DB_USER")
@@ -59,29 +65,362 @@ def export_to_csv(filename, data_to_write, column_names):
         write.writerows(data_to_write)
 
 
-def get_tasks(session, endpoints, access_token):
-    headers = {"Accept": "application/json", "Authorization": f"Bearer {access_token}"}
-    tasks = []
-    for endpoint in endpoints:
-        tasks.append(asyncio.create_task(session.post(endpoint, headers=headers)))
-    asyncio.sleep(2)
-    return tasks
+def batch_iterable(iterable, batch_size):
+    """Helper function to split any iterable into lists of a fixed size, without reading more of the iterable than one batch at a time
+
+    Args:
+        iterable (iterable): Values to split into batches, e.g. a generator of rows
+        batch_size (int): Maximum number of values in each batch
+
+    Yields:
+        list: The next batch of values, the final batch may be shorter than batch_size
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, batch_size))
+
+
+def partition_rows(rows, column_index, partitions):
+    """Helper function to split rows into contiguous key ranges of roughly equal size
+
+    The rows are sorted on the key column and rows sharing a key value are always kept in the same partition, so the partitions cover separate ranges of the key. NULL keys sort last.
+
+    Args:
+        rows (list): Rows to split
+        column_index (int): Position of the key column in each row
+        partitions (int): Number of partitions wanted, fewer are returned if there aren't enough distinct keys
+
+    Returns:
+        list: One list of rows per partition, in key order
+    """
+    get_key = itemgetter(column_index)
+    rows = sorted(rows, key=lambda row: (get_key(row) is None, get_key(row)))
+    partition_size = -(-len(rows) // max(partitions, 1))
+
+    row_partitions = []
+    start = 0
+    while start < len(rows):
+        end = min(start + partition_size, len(rows))
+        while end < len(rows) and get_key(rows[end]) == get_key(rows[end - 1]):
+            end += 1
+        row_partitions.append(rows[start:end])
+        start = end
+
+    return row_partitions
+
+
+def run_pipeline(items, consume, max_queued):
+    """Helper function to overlap producing and consuming work, e.g. fetching from an API while uploading to a database
+
+    items is iterated on a background thread and each item is passed through a bounded queue to consume() on the calling thread. When the queue is full the producer waits, so it never gets more than max_queued items ahead of the consumer.
+
+    Args:
+        items (iterable): Produces the work, e.g. a generator that fetches data from an API
+        consume (function): Called with each item in order
+        max_queued (int): Maximum number of items waiting to be consumed. 0 runs both stages one after the other on the calling thread.
+
+    Returns:
+        dict: Number of 'items' processed, 'producer_seconds' and 'consumer_seconds' spent working and 'producer_wait_seconds' spent blocked on a full queue
+    """
+    pipeline_stats = {
+        "items": 0,
+        "producer_seconds": 0.0,
+        "consumer_seconds": 0.0,
+        "producer_wait_seconds": 0.0,
+    }
+    iterator = iter(items)
+
+    if max_queued <= 0:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            pipeline_stats["producer_seconds"] += time.perf_counter() - started
+
+            started = time.perf_counter()
+            consume(item)
+            pipeline_stats["consumer_seconds"] += time.perf_counter() - started
+            pipeline_stats["items"] += 1
+        return pipeline_stats
+
+    item_queue = queue.Queue(maxsize=max_queued)
+    stopped = threading.Event()
+
+    def put(message):
+        # * Time out regularly so the producer can give up if the consumer has stopped
+        while not stopped.is_set():
+            try:
+                item_queue.put(message, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            while not stopped.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                pipeline_stats["producer_seconds"] += time.perf_counter() - started
+
+                started = time.perf_counter()
+                put(("item", item))
+                pipeline_stats["producer_wait_seconds"] += time.perf_counter() - started
+        except Exception as e:
+            put(("error", e))
+        put(("done", None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            message_type, item = item_queue.get()
+            if message_type == "done":
+                break
+            if message_type == "error":
+                raise item
+
+            started = time.perf_counter()
+            consume(item)
+            pipeline_stats["consumer_seconds"] += time.perf_counter() - started
+            pipeline_stats["items"] += 1
+    finally:
+        stopped.set()
+        producer.join()
+
+    return pipeline_stats
+
+
+async def fetch_endpoint(
+    session, semaphore, endpoint, http_method, headers, json_body, max_retries
+):
+    """Sends one request, retrying timeouts, connection errors and RETRY_STATUSES responses with jittered exponential backoff
+
+    Args:
+        session (aiohttp.ClientSession): Session the request is sent through, its timeout applies to each attempt
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight
+        endpoint (str): The full url to request
+        http_method (str): HTTP method e.g. 'GET' or 'POST'
+        headers (dict): Request headers
+        json_body (dict): JSON body to send, or None
+        max_retries (int): Number of times a failed request is retried
+
+    Returns:
+        bool: False if the request failed
+        dict: The decoded JSON response
+    """
+    import asyncio
+
+    import aiohttp
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        try:
+            async with semaphore:
+                async with session.request(
+                    http_method, endpoint, headers=headers, json=json_body
+                ) as response:
+                    if response.status < 400:
+                        try:
+                            return await response.json(content_type=None)
+                        except (ValueError, aiohttp.ContentTypeError) as e:
+                            logging.error(
+                                f"{http_method} {endpoint} did not return JSON: {e}"
+                            )
+                            return False
+                    if (
+                        response.status
+                        not in shared_constants.ASYNC_HTTP_RETRY_STATUSES
+                    ):
+                        logging.error(
+                            f"{http_method} {endpoint} returned {response.status}"
+                        )
+                        return False
+                    retry_after = response.headers.get("Retry-After")
+                    error = f"status {response.status}"
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            error = repr(e)
+
+        if attempt == max_retries:
+            break
+
+        # * Jitter stops requests that failed together from retrying together
+        backoff = (
+            shared_constants.ASYNC_HTTP_BACKOFF_SECONDS
+            * 2**attempt
+            * random.uniform(0.5, 1.5)
+        )
+        try:
+            backoff = max(backoff, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        logging.warning(
+            f"{http_method} {endpoint} failed with {error}, retrying in {backoff:.1f}s"
+        )
+        await asyncio.sleep(backoff)
+
+    logging.error(
+        f"{http_method} {endpoint} failed after {max_retries + 1} attempts: {error}"
+    )
+    return False
+
+
+async def iter_endpoints(
+    endpoints,
+    access_token=None,
+    http_method="GET",
+    json_body=None,
+    concurrency=None,
+    timeout=None,
+    max_retries=None,
+):
+    """Requests every endpoint concurrently, yielding each result as soon as it completes
+
+    Args:
+        endpoints (list): Full urls to request
+        access_token (str, optional): Sent as a Bearer token. Defaults to None.
+        http_method (str, optional): HTTP method e.g. 'GET' or 'POST'. Defaults to 'GET'.
+        json_body (dict, optional): JSON body sent with every request. Defaults to None.
+        concurrency (int, optional): Maximum requests in flight. Defaults to ASYNC_HTTP_CONCURRENCY.
+        timeout (float, optional): Seconds allowed for each attempt. Defaults to ASYNC_HTTP_TIMEOUT_SECONDS.
+        max_retries (int, optional): Number of times a failed request is retried. Defaults to ASYNC_HTTP_MAX_RETRIES.
+
+    Yields:
+        tuple: Position of the endpoint in endpoints, and the decoded JSON response or False if the request failed
+    """
+    import asyncio
+
+    import aiohttp
+
+    if concurrency is None:
+        concurrency = shared_constants.ASYNC_HTTP_CONCURRENCY
+    if timeout is None:
+        timeout = shared_constants.ASYNC_HTTP_TIMEOUT_SECONDS
+    if max_retries is None:
+        max_retries = shared_constants.ASYNC_HTTP_MAX_RETRIES
+
+    headers = {"Accept": "application/json"}
+    if access_token:
+        headers["Authorization"] = f"Bearer {access_token}"
 
+    semaphore = asyncio.Semaphore(concurrency)
 
-async def get_endpoints(endpoints, access_token):
-    results = []
-    connector = aiohttp.TCPConnector(limit_per_host=1)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        tasks = get_tasks(session, endpoints, access_token)
-        responses = await asyncio.gather(*tasks)
-        for response in responses:
-            results.append(await response.json())
-    return results
+    async def fetch(index, endpoint):
+        return index, await fetch_endpoint(
+            session,
+            semaphore,
+            endpoint,
+            http_method.upper(),
+            headers,
+            json_body,
+            max_retries,
+        )
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as session:
+        tasks = [
+            asyncio.ensure_future(fetch(index, endpoint))
+            for index, endpoint in enumerate(endpoints)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def iter_call_endpoints(endpoints, access_token=None, http_method="GET", **kwargs):
+    """Synchronous version of iter_endpoints() for use in Function handlers
+
+    The event loop runs on a background thread, so this works whether or not the caller already has an event loop running. Results are passed back as they complete. If the caller stops iterating early, the requests still in flight are cancelled and the background thread is joined.
+
+    Args:
+        endpoints (list): Full urls to request
+        access_token (str, optional): Sent as a Bearer token. Defaults to None.
+        http_method (str, optional): HTTP method e.g. 'GET' or 'POST'. Defaults to 'GET'.
+        **kwargs: json_body, concurrency, timeout or max_retries, see iter_endpoints()
+
+    Yields:
+        tuple: Position of the endpoint in endpoints, and the decoded JSON response or False if the request failed
+    """
+    import asyncio
+
+    result_queue = queue.Queue()
+    # * Set if the caller stops iterating early
+    stop = threading.Event()
+    running = {}
 
+    async def produce():
+        running["loop"] = asyncio.get_running_loop()
+        running["task"] = asyncio.current_task()
+        if stop.is_set():
+            return
+        results = iter_endpoints(endpoints, access_token, http_method, **kwargs)
+        try:
+            async for result in results:
+                if stop.is_set():
+                    break
+                result_queue.put(("result", result))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await results.aclose()
 
-def async_call_endpoints(endpoints, access_token):
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as e:
+            result_queue.put(("error", e))
+        result_queue.put(("done", None))
 
-    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    data = asyncio.run(get_endpoints(endpoints, access_token))
+    producer = threading.Thread(target=run, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            message_type, result = result_queue.get()
+            if message_type == "done":
+                break
+            if message_type == "error":
+                raise result
+            yield result
+    finally:
+        stop.set()
+        if "task" in running:
+            try:
+                running["loop"].call_soon_threadsafe(running["task"].cancel)
+            except RuntimeError:
+                # * The event loop has already finished and been closed
+                pass
+        producer.join()
+
+
+def async_call_endpoints(endpoints, access_token, http_method="POST", **kwargs):
+    """Requests every endpoint concurrently and waits for them all, see iter_call_endpoints()
+
+    Args:
+        endpoints (list): Full urls to request
+        access_token (str): Sent as a Bearer token
+        http_method (str, optional): HTTP method e.g. 'GET' or 'POST'. Defaults to 'POST'.
+        **kwargs: json_body, concurrency, timeout or max_retries, see iter_endpoints()
+
+    Returns:
+        list: Decoded JSON responses in the same order as endpoints, False for any request that failed
+    """
+    data = [False] * len(endpoints)
+    for index, result in iter_call_endpoints(
+        endpoints, access_token, http_method, **kwargs
+    ):
+        data[index] = result
 
     return data
@@ -0,0 +1,73 @@
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import shared_constants
+
+# * One session per host, kept for the life of the (warm) Function instance so connections are reused between invocations
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """Returns the pooled session for the host of the url supplied, creating it on first use
+
+    Args:
+        url (str): Any url on the host to be requested
+
+    Returns:
+        requests.Session: Session with a keep-alive connection pool mounted for the host
+    """
+    url_parts = urlsplit(url)
+    host = f"{url_parts.scheme}://{url_parts.netloc}"
+
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            logging.info(f"Creating HTTP connection pool for {host}")
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=shared_constants.HTTP_POOL_MAXSIZE,
+            )
+            session = requests.Session()
+            session.mount(host, adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _sessions[host] = session
+
+    return session
+
+
+def request(http_method, url, timeout=None, **kwargs):
+    """Sends a request through the pooled session for the url's host
+
+    Args:
+        http_method (str): HTTP method e.g. 'GET' or 'POST'
+        url (str): The full url to request
+        timeout (tuple, optional): (connect, read) timeout in seconds. Defaults to the HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT constants.
+        **kwargs: Any other arguments accepted by requests.Session.request e.g. headers or json
+
+    Returns:
+        requests.Response: The response returned by the server
+    """
+    if timeout is None:
+        timeout = (
+            shared_constants.HTTP_CONNECT_TIMEOUT,
+            shared_constants.HTTP_READ_TIMEOUT,
+        )
+
+    session = get_session(url)
+
+    return session.request(http_method.upper(), url, timeout=timeout, **kwargs)
+
+
+def get(url, **kwargs):
+    """Sends a GET request through the pooled session, see request()"""
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Sends a POST request through the pooled session, see request()"""
+    return request("POST", url, **kwargs)
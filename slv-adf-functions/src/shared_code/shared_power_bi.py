@@ -1,26 +1,172 @@
 import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+from . import shared_azure, shared_constants, shared_http
 
-from . import shared_azure
+# * Power BI throttles per tenant, so a 429 on one request pauses every worker until the Retry-After has passed
+_throttle_lock = threading.Lock()
+_throttled_until = [0.0]
+
+
+def get_retry_after(response):
+    """Reads the number of seconds to wait from a throttled response
+
+    Args:
+        response (requests.Response): Response with a 429 status code
+
+    Returns:
+        float: Seconds to wait, POWER_BI_DEFAULT_RETRY_AFTER if the header is missing or is a date, capped at POWER_BI_MAX_RETRY_AFTER
+    """
+    try:
+        retry_after = float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        retry_after = shared_constants.POWER_BI_DEFAULT_RETRY_AFTER
+
+    return min(max(retry_after, 0), shared_constants.POWER_BI_MAX_RETRY_AFTER)
 
 
 def get_data_from_power_bi(endpoint, access_token):
+    """Sends a GET request to the Power BI REST API, waiting and retrying when the API responds with 429 Too Many Requests
+
+    Args:
+        endpoint (str): Endpoint relative to https://api.powerbi.com/v1.0/myorg/
+        access_token (str): Power BI access token
 
+    Returns:
+        dict: The decoded response, empty if the request was still throttled after POWER_BI_MAX_RETRIES retries
+    """
     base_url = "https://api.powerbi.com/v1.0/myorg/"
     header = {"Authorization": f"Bearer {access_token}"}
 
-    request = requests.get(f"{base_url}{endpoint}", headers=header)
-    content = json.loads(request.content)
+    for attempt in range(shared_constants.POWER_BI_MAX_RETRIES + 1):
+        with _throttle_lock:
+            wait_seconds = _throttled_until[0] - time.monotonic()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+        request = shared_http.get(f"{base_url}{endpoint}", headers=header)
+        if request.status_code != 429:
+            return json.loads(request.content)
+
+        retry_after = get_retry_after(request)
+        logging.warning(
+            f"Power BI throttled {endpoint}, retrying in {retry_after:g}s (attempt {attempt + 1})"
+        )
+        with _throttle_lock:
+            _throttled_until[0] = max(
+                _throttled_until[0], time.monotonic() + retry_after
+            )
+
+    logging.error(f"Power BI still throttling {endpoint}, giving up")
+    return {}
+
+
+def load_refresh_cache(cache_path=None):
+    """Reads the refresh histories saved by the last report run
+
+    Args:
+        cache_path (str, optional): Path of the cache file. Defaults to POWER_BI_REFRESH_CACHE_PATH.
+
+    Returns:
+        dict: Refreshes keyed by dataset id, most recent first. Empty if there is no cache or it can't be read.
+    """
+    cache_path = cache_path or shared_constants.POWER_BI_REFRESH_CACHE_PATH
+
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Unable to read Power BI refresh cache, starting afresh: {e}")
+        return {}
+
+
+def save_refresh_cache(refresh_cache, cache_path=None):
+    """Writes the refresh histories for the next report run. The file is replaced in one step so a failed write leaves the previous cache intact.
+
+    Args:
+        refresh_cache (dict): Refreshes keyed by dataset id, most recent first
+        cache_path (str, optional): Path of the cache file. Defaults to POWER_BI_REFRESH_CACHE_PATH.
+    """
+    cache_path = cache_path or shared_constants.POWER_BI_REFRESH_CACHE_PATH
+
+    try:
+        with open(f"{cache_path}.tmp", "w", encoding="utf-8") as cache_file:
+            json.dump(refresh_cache, cache_file)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    except OSError as e:
+        logging.warning(f"Unable to save Power BI refresh cache: {e}")
+
+
+def get_refresh_id(refresh):
+    return refresh.get("requestId") or refresh.get("id")
+
+
+def get_dataset_refreshes(endpoint, cached_refreshes, access_token):
+    """Retrieves the most recent POWER_BI_REFRESH_HISTORY_TOP refreshes of a dataset, only downloading refreshes that aren't already cached where possible
+
+    The latest POWER_BI_REFRESH_PROBE_TOP refreshes are requested first. If any of them are already cached (a hit), they are merged into the cached refreshes, updating the status of any that were in progress. Otherwise (a miss) the full window is requested.
+
+    Args:
+        endpoint (str): The dataset's refreshes endpoint
+        cached_refreshes (list): Refreshes retrieved by the last report run, most recent first
+        access_token (str): Power BI access token
+
+    Returns:
+        list: Refreshes, most recent first, None if the API didn't return any
+        bool: True if the cache was used
+        int: Number of refreshes that weren't in the cache
+    """
+    top = shared_constants.POWER_BI_REFRESH_HISTORY_TOP
+    probe_top = min(shared_constants.POWER_BI_REFRESH_PROBE_TOP, top)
+    cached_ids = {get_refresh_id(refresh) for refresh in cached_refreshes or []}
+
+    refreshes = get_data_from_power_bi(
+        f"{endpoint}?$top={probe_top if cached_ids else top}", access_token
+    ).get("value")
+    cache_hit = bool(refreshes) and any(
+        get_refresh_id(refresh) in cached_ids for refresh in refreshes
+    )
+
+    if cache_hit:
+        probe_ids = {get_refresh_id(refresh) for refresh in refreshes}
+        refreshes = refreshes + [
+            refresh
+            for refresh in cached_refreshes
+            if get_refresh_id(refresh) not in probe_ids
+        ]
+        refreshes = refreshes[:top]
+    elif cached_ids and refreshes and len(refreshes) == probe_top:
+        refreshes = get_data_from_power_bi(f"{endpoint}?$top={top}", access_token).get(
+            "value"
+        )
+
+    new_refreshes = sum(
+        get_refresh_id(refresh) not in cached_ids for refresh in refreshes or []
+    )
 
-    return content
+    return refreshes, cache_hit, new_refreshes
 
 
 def get_refresh_history():
+    """Retrieves the refresh history of every dataset in every Power BI workspace
+
+    The datasets of each workspace, and then the refreshes of each dataset, are requested POWER_BI_CONCURRENCY at a time. Only the most recent POWER_BI_REFRESH_HISTORY_TOP refreshes are retrieved, and refreshes seen by the last run are read from the refresh cache.
+
+    Returns:
+        bool: False if no workspaces were returned
+        dict: Refresh history keyed by workspace name and then dataset name, in the order the API returns them
+    """
     logging.info("Getting Power BI refresh information")
+    started = time.perf_counter()
     access_token = shared_azure.authenticate_by_client_token()
     refresh_history = {}
+    refresh_cache = load_refresh_cache()
 
     groups = get_data_from_power_bi("groups", access_token)
     groups = groups.get("value")
@@ -28,31 +174,64 @@ def get_refresh_history():
         logging.error("No groups returned")
         return False
 
-    for group in groups:
-
-        group_id = group["id"]
-        group_name = group["name"]
-
-        refresh_history[group_name] = {}
-
-        datasets = get_data_from_power_bi(
-            f"admin/groups/{group_id}/datasets", access_token
+    with ThreadPoolExecutor(
+        max_workers=shared_constants.POWER_BI_CONCURRENCY
+    ) as executor:
+        group_datasets = executor.map(
+            lambda group: get_data_from_power_bi(
+                f"admin/groups/{group['id']}/datasets", access_token
+            ),
+            groups,
         )
-        datasets = datasets.get("value")
 
-        if not datasets:
-            logging.info(f"No datasets retrieved for {group_name}")
-
-        for dataset in datasets:
-
-            dataset_id = dataset["id"]
-            dataset_name = dataset["name"]
-            dataset_refresh_history = get_data_from_power_bi(
-                f"groups/{group_id}/datasets/{dataset_id}/refreshes", access_token
-            )
-
-            dataset_refresh_history = dataset_refresh_history.get("value")
+        dataset_requests = []
+        for group, datasets in zip(groups, group_datasets):
+            group_name = group["name"]
+            refresh_history[group_name] = {}
+
+            datasets = datasets.get("value")
+            if not datasets:
+                logging.info(f"No datasets retrieved for {group_name}")
+                continue
+
+            for dataset in datasets:
+                dataset_requests.append(
+                    (
+                        group_name,
+                        dataset["name"],
+                        dataset["id"],
+                        f"groups/{group['id']}/datasets/{dataset['id']}/refreshes",
+                    )
+                )
+
+        dataset_refresh_histories = executor.map(
+            lambda dataset_request: get_dataset_refreshes(
+                dataset_request[3],
+                refresh_cache.get(dataset_request[2]),
+                access_token,
+            ),
+            dataset_requests,
+        )
 
+        # * Datasets that no longer exist drop out of the cache
+        updated_refresh_cache = {}
+        cache_stats = {"hits": 0, "misses": 0, "new_refreshes": 0}
+        for (group_name, dataset_name, dataset_id, _), (
+            dataset_refresh_history,
+            cache_hit,
+            new_refreshes,
+        ) in zip(dataset_requests, dataset_refresh_histories):
             refresh_history[group_name][dataset_name] = dataset_refresh_history
-
+            if dataset_refresh_history:
+                updated_refresh_cache[dataset_id] = dataset_refresh_history
+            cache_stats["hits" if cache_hit else "misses"] += 1
+            cache_stats["new_refreshes"] += new_refreshes
+
+    save_refresh_cache(updated_refresh_cache)
+    logging.info(
+        f"Refresh cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['new_refreshes']} new refreshes retrieved"
+    )
+    logging.info(
+        f"Refresh history for {len(dataset_requests)} datasets in {len(groups)} workspaces retrieved in {time.perf_counter() - started:.1f}s"
+    )
     return refresh_history